@@ -0,0 +1,460 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sps
+from .utils import shared_array_buffer, arrays_from_shared_buffer
+
+# Supported column widths in bits, in order of preference
+COLUMN_WIDTHS = (1, 4, 8, 16, 32)
+WIDE_COLUMN_DTYPES = {8: np.dtype(np.uint8), 16: np.dtype(np.uint16), 32: np.dtype(np.uint32)}
+
+def column_width(num_values):
+    """
+    Returns the number of bits needed to store a column containing integer
+    values between 0 and num_values - 1.
+    """
+    for width in COLUMN_WIDTHS:
+        if num_values <= 2 ** width:
+            return width
+    raise ValueError(f"Columns with {num_values} values are not supported")
+
+def minimal_uint_dtype(max_value):
+    """Returns the smallest unsigned integer dtype that can hold max_value."""
+    for dtype in WIDE_COLUMN_DTYPES.values():
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError(f"Value {max_value} is too large for discrete data")
+
+def pack_column(values, width):
+    """
+    Packs a 1D array of non-negative integers into a uint8 array (for 1- and
+    4-bit widths) or an unsigned integer array of the given width. Bit-packed
+    columns store row i at bit i % 8 of byte i // 8, and nibble-packed columns
+    store row i in the low (even i) or high (odd i) half of byte i // 2.
+    """
+    if width == 1:
+        return np.packbits(values.astype(bool), bitorder='little')
+    elif width == 4:
+        values = values.astype(np.uint8)
+        if len(values) % 2 == 1:
+            values = np.append(values, np.uint8(0))
+        return values[0::2] | (values[1::2] << 4)
+    return values.astype(WIDE_COLUMN_DTYPES[width])
+
+def unpack_column(packed, width, num_rows):
+    """Unpacks a column created by `pack_column` into an integer array."""
+    if width == 1:
+        return np.unpackbits(packed, count=num_rows, bitorder='little')
+    elif width == 4:
+        values = np.empty(len(packed) * 2, dtype=np.uint8)
+        values[0::2] = packed & 0xF
+        values[1::2] = packed >> 4
+        return values[:num_rows]
+    return packed
+
+def _values_lookup(values, size):
+    """Creates a boolean lookup table of the given size marking the given values."""
+    lookup = np.zeros(size, dtype=bool)
+    values = np.array([v for v in values if 0 <= v < size], dtype=np.int64)
+    lookup[values] = True
+    return lookup
+
+def column_equality_mask(packed, width, num_rows, values):
+    """
+    Computes a boolean mask of the rows in a packed column whose value is one
+    of the given values, without unpacking the column for narrow widths.
+
+    :param packed: A packed column created by `pack_column`.
+    :param width: The width of the packed column in bits.
+    :param num_rows: The number of rows in the column.
+    :param values: An iterable of integer values to match.
+
+    :return: A boolean ndarray of length num_rows.
+    """
+    values = tuple(values)
+    if width == 1:
+        has_zero, has_one = 0 in values, 1 in values
+        if has_zero and has_one:
+            return np.ones(num_rows, dtype=bool)
+        elif not has_zero and not has_one:
+            return np.zeros(num_rows, dtype=bool)
+        bits = np.unpackbits(packed, count=num_rows, bitorder='little').view(bool)
+        return bits if has_one else ~bits
+    elif width == 4:
+        # Look up both nibbles of each byte at once
+        lookup = _values_lookup(values, 16)
+        mask = np.empty(len(packed) * 2, dtype=bool)
+        mask[0::2] = lookup[packed & 0xF]
+        mask[1::2] = lookup[packed >> 4]
+        return mask[:num_rows]
+    elif len(values) == 1:
+        return packed == values[0]
+    elif width == 8:
+        return _values_lookup(values, 256)[packed]
+    return np.isin(packed, values)
+
+class PostingsIndex:
+    """
+    An inverted index from (column, value) pairs to the sorted ids of the rows
+    containing them. Counts are stored for every value, while row ids are
+    only stored for rare values (those appearing in at most `max_count` rows),
+    which keeps the index small and makes masks for rare values cheap.
+    """
+    def __init__(self, value_starts, counts, offsets, rows, max_count):
+        """
+        :param value_starts: An array where value_starts[col] is the position of
+            the first value of column col in counts and offsets.
+        :param counts: The number of rows containing each (column, value) pair,
+            weighted by the row weights of the data if present.
+        :param offsets: Start and end positions in rows of the row ids for each
+            (column, value) pair. Values that are not indexed have empty ranges.
+        :param rows: Concatenated sorted row ids for all indexed values.
+        :param max_count: Values with counts up to this number are indexed.
+        """
+        super().__init__()
+        self.value_starts = value_starts
+        self.counts = counts
+        self.offsets = offsets
+        self.rows = rows
+        self.max_count = max_count
+        
+    @classmethod
+    def build(cls, data, max_fraction):
+        """
+        Builds a postings index over the given ColumnarData.
+        
+        :param data: A ColumnarData object.
+        :param max_fraction: Values present in at most this fraction of rows
+            will have their row ids stored.
+        """
+        max_count = int(max_fraction * data.num_rows)
+        value_starts = np.concatenate([[0], np.cumsum(data.num_values)]).astype(np.int64)
+        counts = np.zeros(value_starts[-1], dtype=np.int64)
+        lengths = np.zeros(value_starts[-1], dtype=np.int64)
+        rows = []
+        for col, name in enumerate(data.column_names):
+            values = data.column_values(name)
+            col_counts = np.bincount(values, minlength=data.num_values[col])
+            rare = col_counts <= max_count
+            if data.row_weights is not None:
+                counts[value_starts[col]:value_starts[col + 1]] = np.bincount(values, weights=data.row_weights, minlength=data.num_values[col])
+            else:
+                counts[value_starts[col]:value_starts[col + 1]] = col_counts
+            lengths[value_starts[col]:value_starts[col + 1]] = np.where(rare, col_counts, 0)
+            if rare.any():
+                rare_rows = np.flatnonzero(rare[values])
+                rows.append(rare_rows[np.argsort(values[rare_rows], kind='stable')].astype(np.int32))
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        return cls(value_starts, counts, offsets, rows, max_count)
+    
+    def _positions(self, col, values):
+        num_values = self.value_starts[col + 1] - self.value_starts[col]
+        return [self.value_starts[col] + v for v in values if 0 <= v < num_values]
+    
+    def count(self, col, values):
+        """Returns the number of rows in which col has one of the given values."""
+        return int(sum(self.counts[p] for p in self._positions(col, values)))
+    
+    def postings(self, col, values):
+        """
+        Returns the sorted ids of the rows in which col has one of the given
+        values, or None if any of the values is not indexed.
+        """
+        positions = self._positions(col, values)
+        if any(self.counts[p] > 0 and self.offsets[p] == self.offsets[p + 1] for p in positions):
+            return None
+        if len(positions) == 1:
+            return self.rows[self.offsets[positions[0]]:self.offsets[positions[0] + 1]]
+        return np.sort(np.concatenate([self.rows[self.offsets[p]:self.offsets[p + 1]] for p in positions] +
+                                      [np.zeros(0, dtype=np.int32)]))
+    
+    def arrays(self):
+        return [self.value_starts, self.counts, self.offsets, self.rows]
+    
+class ColumnarData:
+    """
+    A column-oriented store of discrete data, in which each column is packed
+    using the smallest width that fits its values: 1 bit per row for binary
+    columns, 4 bits for columns with up to 16 values, and 8, 16, or 32 bits
+    beyond that. Masks for slice features are computed directly on the packed
+    columns, so that wide tables take up as little memory as possible.
+    
+    Columns are addressed by name in all public methods. When the store is
+    created from an array, the column names are the column positions.
+    
+    If `row_weights` is set, each row stands for that many identical rows of
+    the original data (see `DiscretizedData.collapse`), and supports are
+    computed as sums of row weights.
+    
+    Columns listed in `ordinal_columns` (such as binned numerical columns)
+    have ordered values. For these columns, bit-packed masks of the rows with
+    values up to each k are built on first use, so that the mask for any range
+    of consecutive values takes one or two bitwise operations.
+    """
+    def __init__(self, packed_columns, widths, num_rows, num_values, column_names=None, row_weights=None, ordinal_columns=None):
+        """
+        :param packed_columns: A list of packed column arrays created by `pack_column`.
+        :param widths: A list of the widths of each column in bits.
+        :param num_rows: The number of rows in the data.
+        :param num_values: An array containing 1 + the maximum value in each
+            column.
+        :param column_names: A list of names for each column. If None, the
+            column positions are used as names.
+        :param row_weights: If not None, an integer array containing the
+            number of original rows represented by each row.
+        :param ordinal_columns: A dictionary mapping the names of ordinal
+            columns to their number of ordered values. Values at or above this
+            number (e.g. a missing-value code) are not part of any range.
+        """
+        super().__init__()
+        self.packed_columns = packed_columns
+        self.widths = widths
+        self.num_rows = num_rows
+        self.num_values = np.asarray(num_values, dtype=np.int64)
+        self.column_names = list(range(len(packed_columns))) if column_names is None else list(column_names)
+        self.column_index = {name: i for i, name in enumerate(self.column_names)}
+        self.row_weights = row_weights
+        self.ordinal_columns = dict(ordinal_columns) if ordinal_columns is not None else {}
+        self._cumulative_masks = {}
+        self.postings_index = None
+        self.postings_fraction = None
+        
+    def build_index(self, max_fraction=0.05):
+        """
+        Builds a postings index of the rows containing each (column, value)
+        pair, storing row ids for values present in at most max_fraction of
+        the rows. Masks, counts, and intersections for features using these
+        values are then computed from the postings instead of scanning the
+        columns.
+        """
+        self.postings_fraction = max_fraction
+        self.postings_index = PostingsIndex.build(self, max_fraction)
+        return self
+
+    @classmethod
+    def from_matrix(cls, mat, column_names=None):
+        """
+        Creates a columnar store from a 2D array or dataframe of non-negative
+        integers. If column_names is None, dataframe columns keep their names.
+        """
+        if column_names is None and isinstance(mat, pd.DataFrame):
+            column_names = list(mat.columns)
+        mat = np.asarray(mat)
+        if mat.size and mat.min() < 0:
+            raise ValueError("Columnar data must contain non-negative integers")
+        num_values = mat.max(axis=0).astype(np.int64) + 1 if mat.shape[0] > 0 else np.ones(mat.shape[1], dtype=np.int64)
+        widths = [column_width(n) for n in num_values]
+        columns = [pack_column(mat[:,i], width) for i, width in enumerate(widths)]
+        return cls(columns, widths, mat.shape[0], num_values, column_names=column_names)
+    
+    @classmethod
+    def from_inputs(cls, inputs, postings_fraction=None):
+        """
+        Returns a columnar store for the given slice finding inputs, reusing
+        the store of a DiscretizedData if it has one.
+        
+        :param inputs: A DiscretizedData, dataframe, or 2D array of discrete
+            values.
+        :param postings_fraction: If not None, a postings index is built for
+            newly created stores.
+        :return: A ColumnarData, or None if the inputs are sparse.
+        """
+        if isinstance(inputs, ColumnarData):
+            return inputs
+        if getattr(inputs, 'columnar', None) is not None:
+            return inputs.columnar
+        data = inputs.df if hasattr(inputs, 'df') else inputs
+        if sps.issparse(data):
+            return None
+        result = cls.from_matrix(data)
+        if postings_fraction is not None:
+            result.build_index(postings_fraction)
+        return result
+
+    @property
+    def shape(self):
+        return (self.num_rows, len(self.packed_columns))
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.packed_columns)
+
+    def column_values(self, col):
+        """Returns an unpacked integer array of the values in the given column."""
+        i = self.column_index[col]
+        return unpack_column(self.packed_columns[i], self.widths[i], self.num_rows)
+
+    def column_mask(self, col, values):
+        """
+        Returns a boolean mask of the rows in which the given column has one of
+        the given values.
+        """
+        rows = self.postings(col, values)
+        if rows is not None:
+            mask = np.zeros(self.num_rows, dtype=bool)
+            mask[rows] = True
+            return mask
+        if col in self.ordinal_columns and len(values) > 1:
+            values = sorted(set(values))
+            if values[0] >= 0 and values[-1] < self.ordinal_columns[col] and values[-1] - values[0] + 1 == len(values):
+                return self.range_mask(col, values[0], values[-1])
+        i = self.column_index[col]
+        return column_equality_mask(self.packed_columns[i], self.widths[i], self.num_rows, values)
+    
+    def cumulative_masks(self, col):
+        """
+        Returns a 2D array of bit-packed masks for an ordinal column, where row
+        k marks the rows whose value is at most k.
+        """
+        if col not in self._cumulative_masks:
+            values = self.column_values(col)
+            self._cumulative_masks[col] = np.stack([np.packbits(values <= k) for k in range(self.ordinal_columns[col])])
+        return self._cumulative_masks[col]
+    
+    def range_mask(self, col, low, high):
+        """
+        Returns a boolean mask of the rows in which an ordinal column has a
+        value between low and high (inclusive).
+        """
+        cumulative = self.cumulative_masks(col)
+        packed = cumulative[high] if low == 0 else cumulative[high] & ~cumulative[low - 1]
+        return np.unpackbits(packed, count=self.num_rows).view(bool)
+    
+    def column_values_at(self, col, rows):
+        """Returns the values of the given column at the given row ids."""
+        i = self.column_index[col]
+        packed, width = self.packed_columns[i], self.widths[i]
+        if width == 1:
+            return (packed[rows >> 3] >> (rows & 7).astype(np.uint8)) & 1
+        elif width == 4:
+            return (packed[rows >> 1] >> (4 * (rows & 1)).astype(np.uint8)) & 0xF
+        return packed[rows]
+    
+    def postings(self, col, values):
+        """
+        Returns the sorted row ids in which the given column has one of the
+        given values, or None if these values are not in the postings index.
+        """
+        if self.postings_index is None: return None
+        return self.postings_index.postings(self.column_index[col], values)
+    
+    def count_rows(self, rows):
+        """
+        Returns the number of original rows represented by the given boolean
+        mask or array of row ids, taking row weights into account.
+        """
+        rows = np.asarray(rows)
+        if self.row_weights is None:
+            return int(rows.sum()) if rows.dtype == bool else len(rows)
+        return int(self.row_weights[rows].sum())
+    
+    def support(self, col, values):
+        """Returns the number of rows in which the column has one of the values."""
+        if self.postings_index is not None:
+            return self.postings_index.count(self.column_index[col], values)
+        return self.count_rows(self.column_mask(col, values))
+    
+    def slice_rows(self, features):
+        """
+        Returns the sorted row ids matching all of the given features, using
+        the postings of the rarest feature and checking the values of the
+        remaining features at those rows only.
+        
+        :param features: A list of (column, values) tuples.
+        :return: An array of row ids, or None if none of the features has
+            indexed postings.
+        """
+        if self.postings_index is None or not features: return None
+        supports = [self.support(col, values) for col, values in features]
+        order = np.argsort(supports)
+        rows = self.postings(*features[order[0]])
+        if rows is None: return None
+        for i in order[1:]:
+            if len(rows) == 0: break
+            col, values = features[i]
+            other_rows = self.postings(col, values)
+            if other_rows is not None:
+                rows = np.intersect1d(rows, other_rows, assume_unique=True)
+            else:
+                rows = rows[np.isin(self.column_values_at(col, rows), values)]
+        return rows
+
+    def row(self, index):
+        """
+        Returns an integer array of the values in the given row, ordered
+        according to column_names.
+        """
+        result = np.empty(len(self.packed_columns), dtype=np.int64)
+        for col, (packed, width) in enumerate(zip(self.packed_columns, self.widths)):
+            if width == 1:
+                result[col] = (packed[index >> 3] >> (index & 7)) & 1
+            elif width == 4:
+                result[col] = (packed[index >> 1] >> (4 * (index & 1))) & 0xF
+            else:
+                result[col] = packed[index]
+        return result
+
+    def take(self, rows):
+        """
+        Returns a new ColumnarData containing only the given rows.
+
+        :param rows: A boolean mask or an array of integer row indexes.
+        """
+        rows = np.asarray(rows)
+        num_rows = int(rows.sum()) if rows.dtype == bool else len(rows)
+        columns = [pack_column(self.column_values(col)[rows], width)
+                   for col, width in zip(self.column_names, self.widths)]
+        result = ColumnarData(columns, list(self.widths), num_rows, self.num_values.copy(),
+                              column_names=self.column_names,
+                              row_weights=self.row_weights[rows] if self.row_weights is not None else None,
+                              ordinal_columns=self.ordinal_columns)
+        if self.postings_index is not None:
+            result.build_index(self.postings_fraction)
+        return result
+
+    def __getitem__(self, rows):
+        return self.take(rows)
+
+    def to_dense(self, dtype=None):
+        """Returns a row-major 2D array containing the unpacked data."""
+        if dtype is None:
+            dtype = WIDE_COLUMN_DTYPES[max(8, *self.widths)] if self.widths else np.uint8
+        result = np.empty(self.shape, dtype=dtype)
+        for i, col in enumerate(self.column_names):
+            result[:,i] = self.column_values(col)
+        return result
+
+    def to_shared(self):
+        """
+        Copies the packed columns into a shared-memory buffer for use in
+        worker processes.
+
+        :return: A tuple (buffer, spec) that can be passed to `from_shared`.
+        """
+        arrays = list(self.packed_columns)
+        has_weights = self.row_weights is not None
+        if has_weights:
+            arrays.append(self.row_weights)
+        index_spec = None
+        if self.postings_index is not None:
+            arrays += self.postings_index.arrays()
+            index_spec = (self.postings_fraction, self.postings_index.max_count)
+        buffer, layout = shared_array_buffer(arrays)
+        return buffer, (layout, list(self.widths), self.num_rows, self.num_values, self.column_names, has_weights, index_spec, self.ordinal_columns)
+
+    @classmethod
+    def from_shared(cls, buffer, spec):
+        """
+        Creates a ColumnarData whose columns (and postings index, if present)
+        are views into a shared-memory buffer created by `to_shared`.
+        """
+        layout, widths, num_rows, num_values, column_names, has_weights, index_spec, ordinal_columns = spec
+        arrays = arrays_from_shared_buffer(buffer, layout)
+        num_columns = len(widths) + int(has_weights)
+        result = cls(arrays[:len(widths)], widths, num_rows, num_values, column_names=column_names,
+                     row_weights=arrays[len(widths)] if has_weights else None,
+                     ordinal_columns=ordinal_columns)
+        if index_spec is not None:
+            result.postings_fraction, max_count = index_spec
+            result.postings_index = PostingsIndex(*arrays[num_columns:], max_count)
+        return result
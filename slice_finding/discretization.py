@@ -2,22 +2,54 @@ import pandas as pd
 import numpy as np
 import scipy.sparse as sps
 import tqdm
+import os
+import itertools
+import zlib
+from .columnar import ColumnarData, minimal_uint_dtype
+from concurrent.futures import ThreadPoolExecutor
 
 class DiscretizedData:
-    def __init__(self, discrete_data, value_names):
+    def __init__(self, discrete_data, value_names, postings_fraction=0.05, row_weights=None, row_inverse=None, ordinal_columns=None):
         """
         :param discrete_data: A dataframe or array containing non-negative
-            integers.
+            integers. Dense data is also stored in a `ColumnarData` (available
+            as the `columnar` attribute), in which each column is packed
+            according to its number of values.
         :param value_names: A list or dictionary of tuples (col, values) where
             col is the column name, and values is a dictionary mapping 
             integer values to strings describing the original values. A list
             should be used if discrete_data is a matrix/array, and a dictionary
             with column names as keys should be used if discrete_data is a
             dataframe.
+        :param postings_fraction: If not None, the columnar store also builds a
+            postings index containing the row ids for each column value that
+            is present in at most this fraction of rows.
+        :param row_weights: If not None, an array containing the number of
+            original rows that each row represents. This is set by `collapse`.
+        :param row_inverse: If not None, an array containing the row of this
+            data that each original row corresponds to.
+        :param ordinal_columns: A dictionary mapping the names of columns
+            whose values are ordered (such as binned columns) to their number
+            of ordered values. See `ColumnarData`.
         """
         super().__init__()
-        self.df = discrete_data.astype(np.uint8)
+        if sps.issparse(discrete_data):
+            self.df = discrete_data.astype(np.uint8)
+            self.columnar = None
+        else:
+            max_value = np.asarray(discrete_data).max() if np.prod(discrete_data.shape) > 0 else 0
+            self.df = discrete_data.astype(minimal_uint_dtype(max_value))
+            # Packed column store used to compute slice masks
+            self.columnar = ColumnarData.from_matrix(self.df)
+            self.columnar.row_weights = row_weights
+            self.columnar.ordinal_columns = dict(ordinal_columns or {})
+            if postings_fraction is not None:
+                self.columnar.build_index(postings_fraction)
+        self.postings_fraction = postings_fraction
         self.value_names = value_names
+        self.row_weights = row_weights
+        self.row_inverse = row_inverse
+        self.ordinal_columns = ordinal_columns
         
         # Create inverse mapping from decoded values to encoded ones, to support
         # converting back user-created slices
@@ -34,7 +66,29 @@ class DiscretizedData:
     
     def filter(self, mask):
         """Returns a new DiscretizedData with only the rows matching the given mask."""
-        return DiscretizedData(self.df[mask], self.value_names)
+        return DiscretizedData(self.df[mask], self.value_names, postings_fraction=self.postings_fraction,
+                               row_weights=self.row_weights[mask] if self.row_weights is not None else None,
+                               ordinal_columns=self.ordinal_columns)
+    
+    def collapse(self):
+        """
+        Returns a new DiscretizedData with one row for each distinct row of
+        this data. The `row_weights` attribute of the result contains the
+        number of times each row occurs, and `row_inverse` maps each original
+        row to its row in the result. Slices found on collapsed data are the
+        same as on the original data when the score functions are collapsed
+        using the same inverse (see `SamplingSliceFinder`).
+        """
+        if sps.issparse(self.df):
+            raise ValueError("Only dense discrete data can be collapsed")
+        if self.row_weights is not None:
+            return self
+        unique_rows, inverse, counts = np.unique(np.asarray(self.df), axis=0, return_inverse=True, return_counts=True)
+        if isinstance(self.df, pd.DataFrame):
+            unique_rows = pd.DataFrame(unique_rows, columns=self.df.columns)
+        return DiscretizedData(unique_rows, self.value_names, postings_fraction=self.postings_fraction,
+                               row_weights=counts, row_inverse=inverse.reshape(-1),
+                               ordinal_columns=self.ordinal_columns)
     
     def describe_slice(self, slice_obj):
         """
@@ -196,19 +250,59 @@ def discretize_column(column_name, column_data, col_spec):
             
         column_desc = (column_name, col_names)
     elif col_spec["method"] == "unique":
-        codes, uniques = pd.factorize(column_data.astype(str), sort=True)
-        unique_vals = sorted(uniques)
+        codes, uniques = _factorize_column(column_data)
         result = np.where(pd.isna(column_data), np.nan, codes)
         column_desc = (column_name, {i: v for i, v in enumerate(uniques)})
         
         if "nan_name" in col_spec:
             # Set the nan value to the max plus one
             result[pd.isna(column_data)] = len(uniques)
-            col_names[len(unique_vals)] = col_spec["nan_name"]
+            column_desc[1][len(uniques)] = col_spec["nan_name"]
     
     return result, column_desc
+
+def _factorize_column(column_data):
+    """
+    Converts the given series into integer codes and a list of string value
+    names, avoiding a string conversion of the whole column when possible.
+    Categorical columns reuse their existing codes, and numeric columns that
+    already contain only whole numbers are factorized numerically. In all
+    cases the codes are the same as those of `pd.factorize` on the column
+    converted to strings: values are numbered in string order, and missing
+    values are assigned a code of -1.
+    """
+    if isinstance(column_data.dtype, pd.CategoricalDtype):
+        return _string_ordered_codes(column_data.cat.codes.values, 
+                                     [str(v) for v in column_data.cat.categories])
     
-def discretize_data(df, spec):
+    if isinstance(column_data.dtype, np.dtype) and np.issubdtype(column_data.dtype, np.number):
+        values = column_data.values
+        present = ~np.isnan(values) if np.issubdtype(values.dtype, np.floating) else None
+        present_values = values[present] if present is not None else values
+        if present is None or np.all(np.mod(present_values, 1) == 0):
+            uniques, present_codes = np.unique(present_values, return_inverse=True)
+            if present is None:
+                codes = present_codes
+            else:
+                codes = np.full(len(values), -1, dtype=np.int64)
+                codes[present] = present_codes
+            return _string_ordered_codes(codes, list(pd.Index(uniques).astype(str)))
+        
+    return pd.factorize(column_data.astype(str), sort=True)
+
+def _string_ordered_codes(codes, names):
+    """
+    Renumbers codes for the given value names so that the names are in string
+    order. Codes of -1 (missing values) are kept.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    order = np.argsort(np.array(names, dtype=object), kind='stable')
+    ranks = np.empty(len(names) + 1, dtype=np.int64)
+    ranks[order] = np.arange(len(names))
+    ranks[-1] = -1
+    return ranks[codes], [names[i] for i in order]
+    
+def discretize_data(df, spec, n_workers=None):
     """
     Discretizes the data according to the given set of rules.
     
@@ -230,26 +324,66 @@ def discretize_data(df, spec):
         - quantiles: If method is 'bin', providing this key specifies quantiles
             at which the values will be binned. Binning follows the same rules as
             for the bins key.
+    :param n_workers: Number of threads to use to discretize columns in
+        parallel. If None, uses one thread per CPU (up to the number of
+        columns). Each thread writes its results directly into the output
+        array. Columns of strings or other Python objects are converted
+        while holding the GIL, so threads do not speed up their
+        discretization.
             
     :return: A DiscretizedData instance representing the dataframe.
     """
-    discrete_columns = np.zeros((len(df), len(spec)), dtype=np.uint8)
+    # Column-major so that each column is written to a contiguous block. The
+    # values are narrowed to the smallest dtype by DiscretizedData
+    discrete_columns = np.zeros((len(df), len(spec)), dtype=np.uint32, order='F')
     column_descriptions = {}
-    for col_idx, (col, col_spec) in enumerate(spec.items()):
+    # Binned columns have ordered values, except for the missing value code
+    ordinal_columns = {}
+    
+    def discretize_into(col_idx, col, col_spec):
         try:
             discrete_columns[:,col_idx], column_descriptions[col_idx] = discretize_column(col, df[col], col_spec)
         except Exception as e:
             raise ValueError(f"Error discretizing column '{col}': {e}")
+        if col_spec["method"] == "bin":
+            ordinal_columns[col_idx] = len(column_descriptions[col_idx][1]) - int("nan_name" in col_spec)
+        
+    if n_workers is None: n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(spec)))
+    if n_workers == 1:
+        for col_idx, (col, col_spec) in enumerate(spec.items()):
+            discretize_into(col_idx, col, col_spec)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(discretize_into, col_idx, col, col_spec)
+                       for col_idx, (col, col_spec) in enumerate(spec.items())]
+            for future in futures:
+                future.result()
     return DiscretizedData(discrete_columns,
-                           column_descriptions)
+                           {col_idx: column_descriptions[col_idx] for col_idx in range(len(spec))},
+                           ordinal_columns=ordinal_columns)
 
-def discretize_token_sets(token_sets, token_idx_mapping=None, n_top_columns=None, max_column_mean=None, show_progress=True):
+def discretize_token_sets(token_sets, 
+                          token_idx_mapping=None, 
+                          n_top_columns=None, 
+                          max_column_mean=None, 
+                          n_hash_features=None,
+                          batch_size=10000,
+                          show_progress=True):
     """
     Performs data "discretization" to convert a given dataset of token sets (e.g.
     sentences) into a sparse representation suitable for slice finding. Each column
     will be 1 if the token set contains at least one token mapping to that column.
     
-    :param token_sets: A list or iterable of lists of tokens.
+    The token sets are consumed as a stream in batches of `batch_size`, and
+    each batch is converted to typed arrays of column indices. Document
+    frequencies are accumulated in a first pass, and the final matrix is
+    assembled in a second pass with only the retained columns.
+    
+    :param token_sets: A list or iterable of lists of tokens. This can be a
+        generator, in which case it is only iterated over once and the column
+        indices of all token sets are kept until the retained columns are
+        known.
     :param token_idx_mapping: If provided, a dictionary of tokens to index
         numbers starting from 0. This can be used to map multiple tokens to the
         same discretized feature. The number of columns in the final discretized
@@ -260,29 +394,98 @@ def discretize_token_sets(token_sets, token_idx_mapping=None, n_top_columns=None
         value will be excluded. For instance, a max_column_mean of 0.5 means that
         columns for which over half the rows have a 1 will be excluded. This
         happens prior to selecting the n_top_columns, if applicable.
+    :param n_hash_features: If provided (and token_idx_mapping is not),
+        tokens are assigned to this many columns using a stable hash function
+        instead of building a vocabulary of all tokens. Column names list the
+        first few tokens seen in each column.
+    :param batch_size: Number of token sets to convert at a time.
     :param show_progress: If True, show a tqdm progress bar.
         
     :return: A `DiscretizedData` object representing the text data in a sparse
         format.
     """
-    # Construct a sparse matrix representation
-    indptr = [0]
-    indices = []
-    data = []
     predefined_token_idx = token_idx_mapping is not None
+    use_hashing = not predefined_token_idx and n_hash_features is not None
     if not predefined_token_idx: token_idx_mapping = {}
+    # For hashed columns, a few example tokens for each column
+    hash_examples = {}
+    example_counts = np.zeros(n_hash_features if use_hashing else 0, dtype=np.int64)
     
-    for token_set in tqdm.tqdm(token_sets) if show_progress else token_sets:
-        if not predefined_token_idx:
-            for token in token_set:
-                token_idx_mapping.setdefault(token, len(token_idx_mapping))
-        grouped_indices = list(set(token_idx_mapping[token] for token in token_set if token in token_idx_mapping))
-        indices += grouped_indices
-        data += [1] * len(grouped_indices)
-        indptr.append(len(indices))
-    bow_mat = sps.csr_matrix((data, indices, indptr), dtype=np.uint8)
+    def token_batches():
+        token_set_iter = iter(tqdm.tqdm(token_sets) if show_progress else token_sets)
+        while True:
+            batch = list(itertools.islice(token_set_iter, batch_size))
+            if not batch: break
+            yield batch
+            
+    def add_hash_examples(tokens, token_hashes, token_ids):
+        # Distinct tokens (by their full hash) in order of first appearance,
+        # and the rank of each one among the distinct tokens of its column
+        first = np.sort(np.unique(token_hashes, return_index=True)[1])
+        ids = token_ids[first]
+        order = np.argsort(ids, kind='stable')
+        ranks = np.empty(len(ids), dtype=np.int64)
+        ranks[order] = np.arange(len(ids)) - np.searchsorted(ids[order], ids[order])
+        for i in first[ranks + example_counts[ids] < 3]:
+            examples = hash_examples.setdefault(token_ids[i], [])
+            if len(examples) < 3 and tokens[i] not in examples:
+                examples.append(tokens[i])
+                example_counts[token_ids[i]] += 1
+            
+    def batch_columns(batch, collect_examples=True):
+        """
+        Returns the sorted column indices present in each row of the batch
+        (concatenated), and the number of columns in each row.
+        """
+        tokens = [token for token_set in batch for token in token_set]
+        if use_hashing:
+            token_hashes = np.fromiter((zlib.crc32(str(token).encode('utf-8')) for token in tokens),
+                                       dtype=np.int64, count=len(tokens))
+            token_ids = token_hashes % n_hash_features
+            if collect_examples and len(tokens) > 0:
+                add_hash_examples(tokens, token_hashes, token_ids)
+        elif predefined_token_idx:
+            token_ids = np.fromiter((token_idx_mapping.get(token, -1) for token in tokens),
+                                    dtype=np.int64, count=len(tokens))
+        else:
+            token_ids = np.fromiter((token_idx_mapping.setdefault(token, len(token_idx_mapping)) for token in tokens),
+                                    dtype=np.int64, count=len(tokens))
+            
+        # Deduplicate column indices within each row, leaving them sorted by
+        # row and then by column
+        rows = np.repeat(np.arange(len(batch), dtype=np.int64), [len(token_set) for token_set in batch])
+        known = token_ids >= 0
+        keys = np.unique((rows[known] << 32) | token_ids[known])
+        return (keys & 0xFFFFFFFF).astype(np.int32), np.bincount(keys >> 32, minlength=len(batch))
+    
+    # Token sets that can be iterated over again are read twice: first to
+    # count the rows containing each column, then to build the matrix from
+    # the retained columns only. An iterator can only be read once, so the
+    # column indices of its batches are kept (as compact arrays) until the
+    # retained columns are known.
+    two_pass = iter(token_sets) is not token_sets
+    batch_indices = []
+    doc_freq = np.zeros(0, dtype=np.int64)
+    num_rows = 0
+    for batch in token_batches():
+        cols, row_counts = batch_columns(batch)
+        if not two_pass:
+            batch_indices.append((cols, row_counts))
+        col_counts = np.bincount(cols)
+        if len(col_counts) > len(doc_freq):
+            doc_freq = np.concatenate([doc_freq, np.zeros(len(col_counts) - len(doc_freq), dtype=np.int64)])
+        doc_freq[:len(col_counts)] += col_counts
+        num_rows += len(batch)
 
-    col_sums = np.array(bow_mat.mean(axis=0)).flatten()
+    if use_hashing:
+        num_cols = n_hash_features
+    elif predefined_token_idx:
+        num_cols = max(token_idx_mapping.values()) + 1 if token_idx_mapping else 0
+    else:
+        num_cols = len(token_idx_mapping)
+    doc_freq = np.concatenate([doc_freq, np.zeros(max(0, num_cols - len(doc_freq)), dtype=np.int64)])
+    
+    col_sums = doc_freq / max(num_rows, 1)
     cols_to_keep = np.flip(np.argsort(col_sums))
     if max_column_mean is not None:
         excluding_cols = cols_to_keep[col_sums[cols_to_keep] >= max_column_mean]
@@ -291,15 +494,41 @@ def discretize_token_sets(token_sets, token_idx_mapping=None, n_top_columns=None
         cols_to_keep = cols_to_keep[col_sums[cols_to_keep] < max_column_mean]
     if n_top_columns is not None:
         cols_to_keep = cols_to_keep[:n_top_columns]
-
-    bow_mat = bow_mat.tocsc()[:,cols_to_keep].tocsr()
+        
+    # Map the retained columns to their new positions, and keep only those
+    # columns from each batch
+    column_map = np.full(len(col_sums), -1, dtype=np.int32)
+    column_map[cols_to_keep] = np.arange(len(cols_to_keep))
+    if two_pass:
+        pruned_batches = (batch_columns(batch, collect_examples=False) for batch in token_batches())
+    else:
+        batch_indices.reverse()
+        pruned_batches = (batch_indices.pop() for _ in range(len(batch_indices)))
+    indptr = [np.zeros(1, dtype=np.int64)]
+    indices = []
+    for cols, row_counts in pruned_batches:
+        new_cols = column_map[cols]
+        kept = new_cols >= 0
+        row_ids = np.repeat(np.arange(len(row_counts)), row_counts)
+        indices.append(new_cols[kept])
+        indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(row_ids[kept], minlength=len(row_counts))))
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+    indptr = np.concatenate(indptr)
+    bow_mat = sps.csr_matrix((np.ones(len(indices), dtype=np.uint8), indices, indptr),
+                             shape=(num_rows, len(cols_to_keep)))
+    bow_mat.sort_indices()
 
     # Create column name mapping
-    unconverted_idx_token = {} # before column filtering
-    for token, idx in token_idx_mapping.items():
-        unconverted_idx_token.setdefault(idx, []).append(token)
+    if use_hashing:
+        unconverted_idx_token = hash_examples
+    else:
+        kept_cols = set(cols_to_keep.tolist())
+        unconverted_idx_token = {} # before column filtering
+        for token, idx in token_idx_mapping.items():
+            if idx in kept_cols:
+                unconverted_idx_token.setdefault(idx, []).append(token)
     value_mapping = {
-        i: (', '.join(unconverted_idx_token[cols_to_keep[i]]), {0: 0, 1: 1})
+        i: (', '.join(str(t) for t in unconverted_idx_token.get(cols_to_keep[i], [])), {0: 0, 1: 1})
         for i in range(len(cols_to_keep))
     }
     
@@ -1,3 +1,5 @@
+import numpy as np
+
 class SliceFilterBase:
     """
     Base class for classes that implement the __call__ function taking a
@@ -191,3 +193,157 @@ class IncludeOnlyFeatureValueSet(SliceFilterBase):
         return cls(data["features"], data["values"])
     
     def __str__(self): return f"<Include: {', '.join(str(x) for x in self.features)} = {', '.join(str(x) for x in self.values)}>"
+
+# Values above this are left to the residual filter, so that the value tables
+# stay small
+MAX_TABLE_VALUE = 1024
+
+def _matches_any(features, values_by_feature):
+    """
+    Returns True if any of the given univariate features allows a value listed
+    for its feature in the given dictionary.
+    """
+    return any(f.feature_name in values_by_feature and 
+               not values_by_feature[f.feature_name].isdisjoint(f.allowed_values)
+               for f in features)
+
+def _is_table_value(value):
+    return isinstance(value, (int, np.integer)) and 0 <= value <= MAX_TABLE_VALUE
+
+class CompiledSliceFilter:
+    """
+    A slice filter reduced to tables over (column, value) pairs, so that the
+    subslices formed by adding one feature to a base slice can be checked all
+    at once before they are created. A slice passes the compiled filter if:
+    
+    * none of its features allows a value in `denied_values`;
+    * for each dictionary in `required_values`, one of its features allows a
+      value in that dictionary; and
+    * it passes the `residual` filter, which holds the parts of the filter tree
+      that cannot be expressed as tables (or None if there are none).
+    
+    Calling the compiled filter on a slice gives the same result as calling
+    the original filter.
+    """
+    def __init__(self, columns, denied_values, required_values, residual=None):
+        """
+        :param columns: A list of the column names of the inputs, which
+            determines the row order of the tables.
+        :param denied_values: A dictionary mapping feature names to sets of
+            values that slices may not contain.
+        :param required_values: A list of dictionaries mapping feature names to
+            sets of values, of which slices must contain at least one.
+        :param residual: A filter to call on slices that pass the tables.
+        """
+        super().__init__()
+        self.denied_values = denied_values
+        self.required_values = required_values
+        self.residual = residual
+        column_index = {col: i for i, col in enumerate(columns)}
+        self.denied_table = self._make_table(column_index, denied_values)
+        self.required_tables = [self._make_table(column_index, values) for values in required_values]
+        
+    def _make_table(self, column_index, values_by_feature):
+        """
+        Creates a boolean array with one row per column and one column per
+        value, which is True where the value is listed for the column.
+        """
+        width = 1 + max((v for values in values_by_feature.values() for v in values), default=0)
+        table = np.zeros((len(column_index), width), dtype=bool)
+        for feature, values in values_by_feature.items():
+            if feature not in column_index: continue
+            table[column_index[feature], list(values)] = True
+        return table
+    
+    def _lookup(self, table, positions, values):
+        in_range = (values >= 0) & (values < table.shape[1])
+        result = np.zeros(len(values), dtype=bool)
+        result[in_range] = table[positions[in_range], values[in_range]]
+        return result
+    
+    def allowed_subslices(self, base_slice, values, positions=None):
+        """
+        Determines which of the subslices formed by adding a single-valued
+        feature to the given base slice pass the denied and required value
+        tables. The residual filter must still be called on the subslices that
+        pass.
+        
+        :param base_slice: The slice to which features are added.
+        :param values: An integer array containing the value of each feature
+            to add.
+        :param positions: The positions in the columns list of the features to
+            add. If None, one feature is added for each column.
+        
+        :return: A boolean array indicating which subslices pass the tables.
+        """
+        values = np.asarray(values, dtype=np.int64)
+        positions = np.arange(len(values)) if positions is None else np.asarray(positions, dtype=np.int64)
+        base_features = base_slice.univariate_features()
+        if _matches_any(base_features, self.denied_values):
+            return np.zeros(len(values), dtype=bool)
+        allowed = ~self._lookup(self.denied_table, positions, values)
+        for required, table in zip(self.required_values, self.required_tables):
+            if not _matches_any(base_features, required):
+                allowed &= self._lookup(table, positions, values)
+        return allowed
+    
+    def __call__(self, slice_obj):
+        features = slice_obj.univariate_features()
+        if _matches_any(features, self.denied_values): return False
+        if not all(_matches_any(features, required) for required in self.required_values): return False
+        return self.residual is None or self.residual(slice_obj)
+    
+def compile_filter(filter_obj, columns):
+    """
+    Compiles a slice filter into a `CompiledSliceFilter` for inputs with the
+    given columns. Exclusions and inclusions of feature values that are combined
+    using `ExcludeIfAny` are converted to value tables, and any other filters
+    (including functions that are not `SliceFilterBase` objects) are kept in
+    the residual filter.
+    
+    :param filter_obj: A slice filter or a function that takes a `Slice` object.
+    :param columns: A list of the column names of the inputs.
+    
+    :return: A `CompiledSliceFilter` object.
+    """
+    denied_values = {}
+    required_values = []
+    residuals = []
+    
+    def add_values(values_by_feature, features, values):
+        for feature in features:
+            values_by_feature.setdefault(feature, set()).update(values)
+    
+    def visit(f):
+        # Subclasses may override __call__, so only exact types are compiled
+        f_type = type(f)
+        if f_type is SliceFilterBase:
+            return
+        elif f_type is ExcludeIfAny:
+            for child in f.children: visit(child)
+        elif f_type is ExcludeIfAll and len(f.children) == 1:
+            visit(f.children[0])
+        elif f_type in (ExcludeFeatureValue, IncludeOnlyFeatureValue) and _is_table_value(f.value):
+            if f_type is ExcludeFeatureValue:
+                add_values(denied_values, [f.feature], [f.value])
+            else:
+                required_values.append({f.feature: {f.value}})
+        elif (f_type in (ExcludeFeatureValueSet, IncludeOnlyFeatureValueSet) and
+              all(_is_table_value(v) for v in f.values)):
+            if f_type is ExcludeFeatureValueSet:
+                add_values(denied_values, f.features, f.values)
+            else:
+                required = {}
+                add_values(required, f.features, f.values)
+                required_values.append(required)
+        else:
+            residuals.append(f)
+            
+    visit(filter_obj)
+    if not residuals:
+        residual = None
+    elif len(residuals) == 1:
+        residual = residuals[0]
+    else:
+        residual = ExcludeIfAny(residuals)
+    return CompiledSliceFilter(columns, denied_values, required_values, residual)
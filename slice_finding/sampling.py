@@ -1,127 +1,103 @@
 import numpy as np
 import pandas as pd
-from .utils import RankedList
+from .utils import RankedList, shared_array_buffer, arrays_from_shared_buffer, auto_batch_size
 from .slices import *
-from .scores import ScoreFunctionBase
+from .scores import ScoreFunctionBase, collapse_score_functions
+from .columnar import ColumnarData
+from .filters import compile_filter
 import tqdm
 import os
 from scipy import sparse as sps
-from multiprocessing import RawArray, Pool
+from multiprocessing import RawArray, RawValue, Pool
 import time
+import queue
+import asyncio
+from statistics import NormalDist
 from functools import partial
 import torch
 
 # Global variables for worker processes
 worker_inputs = None
+worker_source_inputs = None
 worker_score_fns = None
 worker_seen_slices = None
+# Precomputed row subsamples of worker_inputs in which slices are scored, and
+# the subsampled inputs and score functions built from them so far
+worker_subsamples = None
+worker_subsample_cache = {}
+# Shared flag that is set when the main process cancels sampling
+worker_cancel_flag = None
 
 FLOAT_SCORE_DTYPE = np.dtype(np.float64)
 INT_SCORE_DTYPE = np.dtype(np.int64)
 
 def worker_global_init(device,
                        seen_slices,
-                       double_score_data, 
-                    double_score_data_shape, 
-                    double_score_names, 
-                    int_score_data, 
-                    int_score_data_shape, 
-                    int_score_names, 
-                    score_dicts):
+                       cancel_flag,
+                       score_data,
+                       score_data_layout,
+                       score_names,
+                       score_dicts):
     """
     :param seen_slices: A dictionary of slice specs to scores for those slices.
-    :param double_score_data: A RawArray containing the buffer of score data that
-        is in floating-point format
-    :param double_score_data_shape: The shape of the floating-point score data
-        matrix
-    :param double_score_names: Ordered set of names of the floating-point score
-        data
-    :param int_score_data: A RawArray containing the buffer of score data that
-        is in integer format
-    :param int_score_data_shape: The shape of the integer score data
-        matrix
-    :param int_score_names: Ordered set of names of the integer score
-        data
+    :param cancel_flag: A shared RawValue that is nonzero when sampling has
+        been cancelled
+    :param score_data: A RawArray containing the data arrays of the score
+        functions, created by `shared_array_buffer`. Floating-point data is
+        stored as float64 and other data as int64. Collapsed score functions
+        have 2D data arrays.
+    :param score_data_layout: The layout of the arrays in score_data
+    :param score_names: Ordered names of the score functions whose data is
+        stored in score_data
     :param score_dicts: A dictionary mapping score function names to metadata
         dicts for each score function
     """
-    global worker_score_fns, worker_seen_slices
+    global worker_score_fns, worker_seen_slices, worker_cancel_flag
     
     # Initialize score functions from buffers
-    if double_score_data is not None:
-        double_mat = np.frombuffer(double_score_data, dtype=FLOAT_SCORE_DTYPE).reshape(double_score_data_shape)
-    else:
-        double_mat = None
-    if int_score_data is not None:
-        int_mat = np.frombuffer(int_score_data, dtype=INT_SCORE_DTYPE).reshape(int_score_data_shape)
-    else:
-        int_mat = None
-        
     worker_score_fns = {}
-    for i, name in enumerate(double_score_names):
-        worker_score_fns[name] = ScoreFunctionBase.from_dict(score_dicts[name], double_mat[:,i]).to(device)
-    for i, name in enumerate(int_score_names):
-        worker_score_fns[name] = ScoreFunctionBase.from_dict(score_dicts[name], int_mat[:,i]).to(device)
+    for name, data in zip(score_names, arrays_from_shared_buffer(score_data, score_data_layout)):
+        worker_score_fns[name] = ScoreFunctionBase.from_dict(score_dicts[name], data).to(device)
     for name in score_dicts:
         if name not in worker_score_fns:
             worker_score_fns[name] = ScoreFunctionBase.from_dict(score_dicts[name], None).to(device)
             
     worker_seen_slices = seen_slices
+    worker_cancel_flag = cancel_flag
     
     # Try to make the processes a little less CPU-intensive
     try: os.nice(5)
     except: pass
     
-def init_worker_dataframe(inputs, 
-                          inputs_shape, 
-                          inputs_dtype,
-                          input_columns, 
-                          sample_proportion,
-                          device,
-                          *score_fn_args):
+def init_worker_subsamples(subsamples, subsamples_layout):
     """
-    :param inputs: A RawArray containing the buffer of discrete input data
-    :param inputs_shape: The shape of the original discrete input data
-    :param inputs_dtype: Dtype of the input data
-    :param input_columns: Column names for the dataframe
+    :param subsamples: A RawArray created by `shared_array_buffer` containing
+        arrays of row indexes for each subsample, or None if slices are scored
+        on all rows
+    :param subsamples_layout: The layout of the arrays in subsamples
     """
-    global worker_inputs, worker_score_fns
-    
-    # Initialize worker inputs from buffer
-    mat = np.frombuffer(inputs, dtype=inputs_dtype).reshape(inputs_shape)
-    worker_inputs = pd.DataFrame(mat, columns=input_columns)
+    global worker_subsamples, worker_subsample_cache
     
-    worker_global_init(device, *score_fn_args)
-    
-    if sample_proportion < 1.0:
-        worker_sample = np.random.uniform(0.0, 1.0, size=worker_inputs.shape[0]) <= sample_proportion
-        worker_inputs = worker_inputs[worker_sample]
-        worker_score_fns = {k: v.subslice(worker_sample) for k, v in worker_score_fns.items()}
-        
-    
-def init_worker_array(inputs, 
-                          inputs_shape, 
-                          inputs_dtype,
-                          sample_proportion,
-                          device,
-                          *score_fn_args):
+    worker_subsamples = arrays_from_shared_buffer(subsamples, subsamples_layout) if subsamples is not None else None
+    worker_subsample_cache = {}
+
+def init_worker_columnar(inputs,
+                         inputs_spec,
+                         subsamples,
+                         subsamples_layout,
+                         device,
+                         *score_fn_args):
     """
-    :param inputs: A RawArray containing the buffer of discrete input data
-    :param inputs_shape: The shape of the original discrete input data
-    :param inputs_dtype: Dtype of the input data
-    :param input_columns: Column names for the dataframe
+    :param inputs: A RawArray containing the packed columns of a ColumnarData
+    :param inputs_spec: The layout of the packed columns, as returned by
+        `ColumnarData.to_shared`
     """
-    global worker_inputs, worker_score_fns
+    global worker_inputs, worker_source_inputs
     
-    worker_inputs = np.frombuffer(inputs, dtype=inputs_dtype).reshape(inputs_shape)
+    worker_inputs = ColumnarData.from_shared(inputs, inputs_spec)
+    worker_source_inputs = worker_inputs
     worker_global_init(device, *score_fn_args)
-    
-    if sample_proportion < 1.0:
-        worker_sample = np.random.uniform(0.0, 1.0, size=worker_inputs.shape[0]) <= sample_proportion
-        worker_inputs = torch.from_numpy(worker_inputs[worker_sample]).to(device)
-        worker_score_fns = {k: v.subslice(worker_sample) for k, v in worker_score_fns.items()}
-    else:
-        worker_inputs = torch.from_numpy(worker_inputs).to(device)
+    init_worker_subsamples(subsamples, subsamples_layout)
 
 def init_worker_sparse(inputs_data, 
                        inputs_indices,
@@ -129,7 +105,8 @@ def init_worker_sparse(inputs_data,
                        inputs_shape,
                        inputs_dtype,
                        index_dtype,
-                       sample_proportion,
+                       subsamples,
+                       subsamples_layout,
                        device,
                        *score_fn_args):
     """
@@ -141,7 +118,7 @@ def init_worker_sparse(inputs_data,
     :param inputs_dtype: Dtype of the input data
     :param input_columns: Column names for the dataframe
     """
-    global worker_inputs, worker_score_fns
+    global worker_inputs, worker_source_inputs
     
     data_mat = np.frombuffer(inputs_data, dtype=inputs_dtype)
     indices_mat = np.frombuffer(inputs_indices, dtype=index_dtype)
@@ -149,158 +126,731 @@ def init_worker_sparse(inputs_data,
     
     worker_inputs = sps.csr_matrix((data_mat, indices_mat, indptr_mat),
                                    shape=inputs_shape)
+    worker_source_inputs = worker_inputs
     
     worker_global_init(device, *score_fn_args)
+    init_worker_subsamples(subsamples, subsamples_layout)
+    # Column-major copy used to compute slice masks
+    worker_inputs = worker_inputs.tocsc()
+
+def source_row_at(inputs, index):
+    """
+    Returns the row of the inputs at the given index, in the format expected
+    by `explore_groups_beam_search`.
+    """
+    if isinstance(inputs, ColumnarData):
+        return inputs.row(index)
+    return inputs[index]
+
+def source_row_groups(inputs):
+    """
+    Assigns each row of the inputs to a group of rows with identical values,
+    since a beam search from any of these rows explores the same slices.
     
-    if sample_proportion < 1.0:
-        worker_sample = np.random.uniform(0.0, 1.0, size=worker_inputs.shape[0]) <= sample_proportion
-        worker_inputs = worker_inputs[worker_sample]
-        worker_score_fns = {k: v.subslice(worker_sample) for k, v in worker_score_fns.items()}
+    :param inputs: A ColumnarData or binary CSR matrix.
+    :return: An array containing a group id for each row, or None if all rows
+        are known to be distinct (i.e. the inputs have been collapsed).
+    """
+    if isinstance(inputs, ColumnarData):
+        if inputs.row_weights is not None: return None
+        _, groups = np.unique(inputs.to_dense(), axis=0, return_inverse=True)
+        return groups.reshape(-1)
+    inputs = inputs.copy()
+    inputs.sort_indices()
+    group_ids = {}
+    return np.array([group_ids.setdefault(inputs.indices[start:end].tobytes(), len(group_ids))
+                     for start, end in zip(inputs.indptr[:-1], inputs.indptr[1:])], dtype=np.int64)
 
-def explore_groups_worker(source_row, **kwargs):
-    return explore_groups_beam_search(worker_inputs,
-                                      worker_score_fns,
-                                      source_row,
-                                      seen_slices=worker_seen_slices,
-                                      **kwargs)
+def stratified_subsamples(strata, fraction, num_subsamples):
+    """
+    Draws random subsamples of rows that contain the same fraction of the
+    rows in each stratum, so that scores computed on different subsamples
+    vary less than on independent Bernoulli samples.
     
-def explore_groups_beam_search(inputs, 
-                               score_fns, 
-                               source_row, 
-                               col_names=None,
-                               seen_slices=None, 
-                               group_filter=None, 
-                               initial_slice=None,
-                               positive_only=None,
-                               max_features=5, 
-                               min_items=5, 
-                               min_weight=0.0, 
-                               max_weight=5.0, 
-                               num_candidates=20,
-                               device='cpu'):
+    :param strata: An array containing the stratum id of each row.
+    :param fraction: The fraction of rows to include in each subsample. The
+        number of rows drawn from each stratum is rounded up or down at
+        random in proportion to the remainder.
+    :param num_subsamples: The number of subsamples to draw.
+    :return: A list of sorted arrays of row indexes.
+    """
+    stratum_rows = np.split(np.argsort(strata, kind='stable'),
+                            np.cumsum(np.bincount(strata))[:-1])
+    subsamples = []
+    for _ in range(num_subsamples):
+        rows = []
+        for stratum in stratum_rows:
+            if len(stratum) == 0: continue
+            size = len(stratum) * fraction
+            size = int(size) + int(np.random.uniform() < size - int(size))
+            rows.append(np.random.choice(stratum, size=size, replace=False))
+        subsamples.append(np.sort(np.concatenate(rows + [np.zeros(0, dtype=np.int64)])))
+    return subsamples
+
+def worker_subsample(subsample_id):
+    """
+    Returns a tuple (inputs, score_fns, row_indexes) for the worker's inputs
+    restricted to the given precomputed subsample, where row_indexes are the
+    positions of the rows in the full inputs. If subsample_id is None, the
+    full inputs are returned with row_indexes set to None. Subsampled inputs
+    and score functions are built once per worker.
+    """
+    if subsample_id is None or worker_subsamples is None:
+        return worker_inputs, worker_score_fns, None
+    if subsample_id not in worker_subsample_cache:
+        rows = worker_subsamples[subsample_id]
+        inputs = worker_source_inputs[rows]
+        if sps.issparse(inputs): inputs = inputs.tocsc()
+        worker_subsample_cache[subsample_id] = (inputs, 
+                                                {k: v.subslice(rows) for k, v in worker_score_fns.items()}, 
+                                                rows)
+    return worker_subsample_cache[subsample_id]
+
+def worker_cancelled():
+    """Returns True if the main process has cancelled sampling."""
+    return worker_cancel_flag is not None and bool(worker_cancel_flag.value)
+
+def explore_groups_worker(row_indexes, subsample_id=None, top_k=None, **kwargs):
+    """
+    Runs a batched beam search in a worker process starting from the rows at
+    the given indexes of the worker's (unsampled) inputs, and scoring slices
+    on the given precomputed subsample.
+    """
+    source_rows = [source_row_at(worker_source_inputs, i) for i in row_indexes]
+    inputs, score_fns, sample_rows = worker_subsample(subsample_id)
+    results, row_use_counts = explore_groups_batch(inputs,
+                                                   score_fns,
+                                                   source_rows,
+                                                   seen_slices=worker_seen_slices,
+                                                   should_cancel=worker_cancelled,
+                                                   **kwargs)
+    return pack_explore_results(results, row_use_counts, kwargs.get("initial_slice"), top_k=top_k,
+                                row_indexes=sample_rows)
+
+def explore_groups_worker_indexed(worker, batch):
+    """
+    Runs the given worker function on a tuple (batch_id, row_indexes,
+    subsample_id) and returns a tuple (batch_id, results), so that results
+    arriving out of order can be matched to their batches.
+    """
+    batch_id, row_indexes, subsample_id = batch
+    return batch_id, worker(row_indexes, subsample_id=subsample_id)
+
+def _added_features(slice_obj, initial_slice):
+    """
+    Returns the list of features that were added to initial_slice (using
+    `subslice`) to create slice_obj, in the order they were added.
+    """
+    if isinstance(slice_obj, IntersectionSlice) and isinstance(initial_slice, IntersectionSlice):
+        initial_features = set(initial_slice.base_features)
+        return [f for f in slice_obj.base_features if f not in initial_features]
+    added = []
+    feature = slice_obj.feature
+    while feature != initial_slice.feature:
+        if not isinstance(feature, SliceFeatureAnd):
+            # The first feature added to an empty slice
+            added.append(feature)
+            break
+        added.append(feature.rhs)
+        feature = feature.lhs
+    return added[::-1]
+
+def pack_explore_results(slices, row_use_counts, initial_slice=None, top_k=None, row_indexes=None):
+    """
+    Encodes the results of a beam search compactly so that they can be sent
+    from a worker process to the main process. Each slice is represented by
+    the ids of the features added to the initial slice, referring to a table
+    of distinct features, and the use counts are stored sparsely.
+    
+    :param slices: A list of scored Slice objects.
+    :param row_use_counts: An array of the number of times each row was used.
+    :param initial_slice: The slice from which the beam search started.
+    :param top_k: If provided, only the top_k slices for each score function
+        are kept. The union of these slices across workers contains the top_k
+        slices overall for each score function.
+    :param row_indexes: If provided, the row index in the full inputs of
+        each row in row_use_counts, which is used when the beam search ran
+        on a subsample of the inputs.
+        
+    :return: A tuple that can be decoded using `unpack_explore_results`.
+    """
+    if initial_slice is None: initial_slice = IntersectionSlice([])
+    score_names = list(slices[0].score_values.keys()) if slices else []
+    scores = np.array([[s.score_values[name] for name in score_names] for s in slices],
+                      dtype=np.float64).reshape(len(slices), len(score_names))
+    if top_k is not None and len(slices) > top_k:
+        keep = np.zeros(len(slices), dtype=bool)
+        for i in range(len(score_names)):
+            keep[np.argsort(-scores[:,i], kind='stable')[:top_k]] = True
+        slices = [s for s, k in zip(slices, keep) if k]
+        scores = scores[keep]
+        
+    feature_ids = {}
+    feature_table = []
+    slice_features = []
+    for s in slices:
+        ids = []
+        for f in _added_features(s, initial_slice):
+            if f not in feature_ids:
+                feature_ids[f] = len(feature_table)
+                feature_table.append((f.feature_name, f.allowed_values))
+            ids.append(feature_ids[f])
+        slice_features.append(ids)
+    id_matrix = np.full((len(slices), max((len(ids) for ids in slice_features), default=0)), -1, dtype=np.int32)
+    for i, ids in enumerate(slice_features):
+        id_matrix[i,:len(ids)] = ids
+        
+    used_rows = np.flatnonzero(row_use_counts)
+    use_counts = row_use_counts[used_rows]
+    if row_indexes is not None:
+        used_rows = row_indexes[used_rows]
+    return (feature_table, id_matrix, score_names, scores, 
+            (used_rows.astype(np.int32), use_counts))
+
+def unpack_explore_results(packed, initial_slice=None):
+    """
+    Decodes the results of a beam search created by `pack_explore_results`.
+    
+    :return: A tuple (slices, (rows, counts)) where slices is a list of
+        scored Slice objects, and rows and counts describe the number of times
+        each row was used.
+    """
+    if initial_slice is None: initial_slice = IntersectionSlice([])
+    feature_table, id_matrix, score_names, scores, row_use_counts = packed
+    features = [SliceFeature(col, values) for col, values in feature_table]
+    slices = []
+    for ids, slice_scores in zip(id_matrix, scores):
+        new_slice = initial_slice
+        for feature_id in ids:
+            if feature_id < 0: break
+            new_slice = new_slice.subslice(features[feature_id])
+        slices.append(new_slice.rescore(dict(zip(score_names, slice_scores.tolist()))))
+    return slices, row_use_counts
+    
+def _pack_mask_columns(masks):
+    """
+    Compresses the columns of a boolean mask matrix to bit-packed arrays, one
+    for each column.
+    """
+    packed = np.packbits(masks.T.cpu().numpy(), axis=1)
+    return [column.copy() for column in packed]
+
+def _unpack_mask(packed, num_rows, device='cpu'):
+    """Expands a mask compressed by `_pack_mask_columns`."""
+    return torch.from_numpy(np.unpackbits(packed, count=num_rows).view(bool)).to(device)
+
+def _postings_support(inputs, feature, base_mask):
+    """
+    Returns the number of rows in the given base mask that match the feature,
+    using the postings index of a ColumnarData. For values without postings,
+    the overall count of the value is returned as an upper bound.
+    """
+    rows = inputs.postings(feature.feature_name, feature.allowed_values)
+    if rows is None:
+        return inputs.support(feature.feature_name, feature.allowed_values)
+    return inputs.count_rows(rows[base_mask[rows]])
+    
+def sparse_postings(inputs, col):
+    """Returns the sorted ids of the rows where a binary CSC matrix has a 1 in col."""
+    start, end = inputs.indptr[col], inputs.indptr[col + 1]
+    return inputs.indices[start:end][inputs.data[start:end] == 1]
+
+def _sparse_slice_rows(inputs, slice_obj, univariate_masks, device='cpu'):
+    """
+    Returns the sorted ids of the rows in a CSC matrix that belong to the
+    given slice, intersecting column postings when the slice is a conjunction
+    of positive features.
+    """
+    conjunction = conjunction_features(slice_obj.feature)
+    if conjunction is None or any(0 in f.allowed_values for f in conjunction):
+        return np.flatnonzero(slice_obj.make_mask(inputs, univariate_masks=univariate_masks, device=device).cpu().numpy())
+    rows = np.arange(inputs.shape[0])
+    for f in conjunction:
+        if f.allowed_values == (1,):
+            feature_rows = sparse_postings(inputs, f.feature_name)
+        else:
+            feature_rows = np.flatnonzero(sparse_column_mask(inputs, f.feature_name, f.allowed_values))
+        rows = np.intersect1d(rows, feature_rows, assume_unique=True)
+    return rows
+
+def _range_features(source_row, range_columns, skip_columns=(), positive_only=False):
+    """
+    Returns features for the ranges of consecutive values of ordinal columns
+    that contain the source row's value, other than the value by itself and
+    the full range of ordered values.
+    
+    :param source_row: A row in the format returned by `source_row_at`.
+    :param range_columns: A list of tuples (position, column name, number of
+        ordered values) for the ordinal columns.
+    :param skip_columns: Names of columns for which no ranges are created.
+    :param positive_only: If True, ranges do not include the value 0.
+    """
+    features = []
+    for i, col, num_values in range_columns:
+        value = source_row[i]
+        if col in skip_columns or value >= num_values or (positive_only and value == 0): continue
+        for low in range(1 if positive_only else 0, value + 1):
+            for high in range(value, num_values):
+                if low == high or (low == 0 and high == num_values - 1): continue
+                features.append(SliceFeature(col, tuple(range(low, high + 1))))
+    return features
+
+def explore_groups_sparse(inputs, 
+                          score_fns, 
+                          source_row, 
+                          seen_slices=None, 
+                          group_filter=None, 
+                          initial_slice=None,
+                          max_features=5, 
+                          min_items=5, 
+                          min_weight=0.0, 
+                          max_weight=5.0, 
+                          num_candidates=20,
+                          device='cpu',
+                          should_cancel=None,
+                          memory_budget=None):
+    """
+    Performs the beam search of `explore_groups_beam_search` on a binary sparse
+    matrix. The rows in each slice are kept as sorted arrays of row ids, and
+    slices are extended by intersecting these arrays with the postings of the
+    columns present in the source row. Dense masks are only created for the
+    slices in each scoring batch.
+    """
     scored_slices = set()
+    if seen_slices is None: seen_slices = {}
     if initial_slice is None: initial_slice = IntersectionSlice([])
     if num_candidates is not None:
-        # Maintain a ranking for each function separately, as different slices may
-        # maximize different functions
         best_groups = {fn_name: RankedList(num_candidates, [(initial_slice, -1e9)]) 
                         for fn_name in score_fns}
     else:
         best_groups = set([initial_slice])
 
-    if isinstance(inputs, sps.csr_matrix):
-        if inputs.max() > 1:
-            raise ValueError("Sparse matrices must be binary")
-        if positive_only == False:
-            raise ValueError("positive_only must be True or None for sparse matrices")
-        d = sps.lil_matrix((inputs.shape[1], inputs.shape[1]))
-        source_row = source_row.toarray().flatten()
-        d.setdiag(source_row)
-        mat_for_masks = (inputs @ d).tocsc()
-        positive_only = True
+    if inputs.nnz > 0 and inputs.data.max() > 1:
+        raise ValueError("Sparse matrices must be binary")
+    mat_for_masks = inputs if isinstance(inputs, sps.csc_matrix) else inputs.tocsc()
+    if not mat_for_masks.has_sorted_indices:
+        mat_for_masks = mat_for_masks.sorted_indices()
+    num_rows = mat_for_masks.shape[0]
+    
+    # Only the columns present in the source row can be part of a slice
+    if sps.issparse(source_row):
+        input_columns = np.sort(source_row.tocsr().indices)
     else:
-        mat_for_masks = inputs
-        
-    try:
-        input_columns = mat_for_masks.columns
-    except AttributeError:
-        input_columns = np.arange(mat_for_masks.shape[1])
+        input_columns = np.flatnonzero(source_row)
+    column_postings = {col: sparse_postings(mat_for_masks, col) for col in input_columns}
+    if group_filter is not None:
+        compiled_filter = compile_filter(group_filter, np.arange(mat_for_masks.shape[1]))
+        input_values = np.ones(len(input_columns), dtype=np.int64)
+    else:
+        compiled_filter = None
     
     univariate_masks = {}
+    slice_rows = {}
+    # Slices that contain the same rows as one found earlier are not scored.
+    # They are only skipped within this search, since seen_slices persists
+    # across searches
+    slice_fingerprints = set()
+    equivalent_slices = set()
+    row_use_counts = np.zeros(num_rows, dtype=np.int64)
     
-    # Keep track of how many times each row has been used as part of a slice
-    row_use_counts = torch.zeros(mat_for_masks.shape[0], dtype=torch.long, device=device)
-    
-    # Iterate over the columns max_features times
     for col_size in range(max_features):
         if num_candidates is not None:
             saved_groups = set([g for _, gset in best_groups.items() for g in gset.items])
         else:
             saved_groups = set(g for g in best_groups)
-        num_evaluated = 0
         for base_slice in saved_groups:
-            base_mask = base_slice.make_mask(mat_for_masks, univariate_masks=univariate_masks, device=device)
+            if should_cancel is not None and should_cancel():
+                return list(scored_slices), row_use_counts
+            if base_slice not in slice_rows:
+                slice_rows[base_slice] = _sparse_slice_rows(mat_for_masks, base_slice, univariate_masks, device=device)
+            base_rows = slice_rows[base_slice]
             
             prescored_slices = []
-            features_to_score = []
-            
-            for i, col in enumerate(input_columns):
-                # Skip if only slicing using positive values and the row has a negative value
-                if positive_only and not source_row[col]: continue
-                # Skip if we've already looked at this column
-                feature_to_add = SliceFeature(col, (source_row[col],))
+            candidates = []
+            if compiled_filter is not None:
+                base_columns = input_columns[compiled_filter.allowed_subslices(base_slice, input_values, input_columns)]
+            else:
+                base_columns = input_columns
+            for col in base_columns:
+                feature_to_add = SliceFeature(col, (1,))
                 if feature_to_add in base_slice: continue
                 
                 new_slice = base_slice.subslice(feature_to_add)
-                
-                # Skip if the user wants to filter this slice out
-                if new_slice in scored_slices: 
+                if new_slice in scored_slices or new_slice in equivalent_slices: 
                     continue
-                if group_filter is not None and not group_filter(new_slice): 
+                if compiled_filter is not None and compiled_filter.residual is not None and not compiled_filter.residual(new_slice): 
                     continue
 
                 if new_slice in seen_slices:
-                    # Retrieve existing scores
                     slice_scores = seen_slices[new_slice]
                     if not slice_scores: continue
                     new_slice.score_values = slice_scores
                     prescored_slices.append(new_slice)
-                else:
-                    features_to_score.append(feature_to_add)
-                    
+                    continue
+                
+                rows = np.intersect1d(base_rows, column_postings[col], assume_unique=True)
+                fingerprint = (len(rows), hash(rows.tobytes()))
+                if len(rows) < min_items:
+                    seen_slices[new_slice] = None
+                    continue
+                if len(rows) == len(base_rows) or fingerprint in slice_fingerprints:
+                    equivalent_slices.add(new_slice)
+                    continue
+                slice_fingerprints.add(fingerprint)
+                slice_rows[new_slice] = rows
+                candidates.append((new_slice, col))
+                
             new_scored_slices = []
-            
-            mask_width = len(features_to_score)
-            combined_masks = base_mask.repeat(mask_width, 1).T
-            itemized_masks = [univariate_masks[f].repeat(mask_width, 1).T for f in base_slice.univariate_features()]
-            itemized_masks.append(torch.zeros(*combined_masks.shape, dtype=torch.bool).to(device))
-            for i, feature_to_add in enumerate(features_to_score):
-                # Generate a mask for the slice and add it to the mask matrix
-                itemized_masks[-1][:,i] = feature_to_add.make_mask(mat_for_masks, univariate_masks=univariate_masks, device=device)
-                combined_masks[:,i] &= itemized_masks[-1][:,i]
-                new_scored_slices.append(base_slice.subslice(feature_to_add))
+            if candidates:
+                candidate_rows = [slice_rows[new_slice] for new_slice, _ in candidates]
+                row_use_counts += np.bincount(np.concatenate(candidate_rows), minlength=num_rows)
+                base_masks = [f.make_mask(mat_for_masks, univariate_masks=univariate_masks, device=device)
+                              for f in base_slice.univariate_features()]
                 
-            # Remove slices that are too small
-            mask_sums = combined_masks.sum(0)
-            new_scored_slices = [s for i, s in enumerate(new_scored_slices) if mask_sums[i] >= min_items]
-            combined_masks = combined_masks[:,mask_sums >= min_items]
-            itemized_masks = [m[:,mask_sums >= min_items] for m in itemized_masks]
-            mask_width = (mask_sums >= min_items).sum()
-            for i, s in enumerate(new_scored_slices):
-                if mask_sums[i] < min_items:
-                    seen_slices[s] = None
-
-            if mask_width > 0:
-                num_evaluated += 1
-                batch_size = 64
-                row_use_counts += combined_masks.long().sum(1)
-                for start_idx in range(0, len(new_scored_slices), batch_size):
-                    end_idx = min(len(new_scored_slices), start_idx + batch_size)
+                batch_size = auto_batch_size(num_rows, len(score_fns), memory_budget)
+                for start_idx in range(0, len(candidates), batch_size):
+                    if should_cancel is not None and should_cancel():
+                        return list(scored_slices), row_use_counts
+                    batch = candidates[start_idx:start_idx + batch_size]
+                    batch_rows = candidate_rows[start_idx:start_idx + batch_size]
+                    batch_postings = [column_postings[col] for _, col in batch]
                     
-                    computed_scores = torch.zeros((len(score_fns), end_idx - start_idx)).to(device)
-                    for i, (key, scorer) in enumerate(score_fns.items()):
-                        computed_scores[i] = scorer.calculate_score(new_slice, 
-                                                                    combined_masks[:,start_idx:end_idx], 
-                                                                    [m[:,start_idx:end_idx] for m in itemized_masks])
+                    # Build dense masks for this batch only
+                    combined_masks = torch.zeros((num_rows, len(batch)), dtype=torch.bool, device=device)
+                    combined_masks[torch.from_numpy(np.concatenate(batch_rows).astype(np.int64)).to(device),
+                                   torch.from_numpy(np.repeat(np.arange(len(batch)), [len(r) for r in batch_rows])).to(device)] = True
+                    feature_masks = torch.zeros((num_rows, len(batch)), dtype=torch.bool, device=device)
+                    feature_masks[torch.from_numpy(np.concatenate(batch_postings).astype(np.int64)).to(device),
+                                  torch.from_numpy(np.repeat(np.arange(len(batch)), [len(r) for r in batch_postings])).to(device)] = True
+                    itemized_masks = [m.unsqueeze(1).expand(-1, len(batch)) for m in base_masks] + [feature_masks]
                     
-                    new_scored_slices[start_idx:end_idx] = [new_slice.rescore({fn_name: score.item() for fn_name, score in zip(score_fns, computed_scores[:,i])})
-                                        for i, new_slice in enumerate(new_scored_slices[start_idx:end_idx])]
-            else:
-                new_scored_slices = []
+                    computed_scores = torch.zeros((len(score_fns), len(batch))).to(device)
+                    for i, (key, scorer) in enumerate(score_fns.items()):
+                        computed_scores[i] = scorer.calculate_score(batch[-1][0], combined_masks, itemized_masks)
+                    new_scored_slices += [new_slice.rescore({fn_name: score.item() for fn_name, score in zip(score_fns, computed_scores[:,i])})
+                                          for i, (new_slice, _) in enumerate(batch)]
                 
             for new_slice in prescored_slices + new_scored_slices:
                 seen_slices[new_slice] = new_slice.score_values
                 scored_slices.add(new_slice)
                 if num_candidates is not None:
                     for fn_name in score_fns:
-                        # Add to each ranking the score where only the current score
-                        # function's value is maximized
                         score = sum((max_weight if f == fn_name else min_weight) * new_slice.score_values[f] for f in score_fns)
                         best_groups[fn_name].add(new_slice, score)
                 else:
                     best_groups.add(new_slice)
         
-    return list(scored_slices), row_use_counts.cpu().numpy()
+    return list(scored_slices), row_use_counts
+
+def explore_groups_beam_search(inputs, 
+                               score_fns, 
+                               source_row, 
+                               col_names=None,
+                               seen_slices=None, 
+                               group_filter=None, 
+                               initial_slice=None,
+                               positive_only=None,
+                               max_features=5, 
+                               min_items=5, 
+                               min_weight=0.0, 
+                               max_weight=5.0, 
+                               num_candidates=20,
+                               device='cpu',
+                               should_cancel=None,
+                               memory_budget=None,
+                               ordinal_ranges=False):
+    return explore_groups_batch(inputs,
+                                score_fns,
+                                [source_row],
+                                seen_slices=seen_slices,
+                                group_filter=group_filter,
+                                initial_slice=initial_slice,
+                                positive_only=positive_only,
+                                max_features=max_features,
+                                min_items=min_items,
+                                min_weight=min_weight,
+                                max_weight=max_weight,
+                                num_candidates=num_candidates,
+                                device=device,
+                                should_cancel=should_cancel,
+                                memory_budget=memory_budget,
+                                ordinal_ranges=ordinal_ranges)
+
+def explore_groups_batch(inputs, 
+                         score_fns, 
+                         source_rows, 
+                         seen_slices=None, 
+                         group_filter=None, 
+                         initial_slice=None,
+                         positive_only=None,
+                         max_features=5, 
+                         min_items=5, 
+                         min_weight=0.0, 
+                         max_weight=5.0, 
+                         num_candidates=20,
+                         device='cpu',
+                         should_cancel=None,
+                         memory_budget=None,
+                         ordinal_ranges=False):
+    """
+    Runs a beam search starting from each of a batch of source rows. At each
+    level, the candidate slices of all the rows' beams are pooled so that
+    slices shared between rows are scored only once, and the scores are then
+    distributed back to each row's beam.
+    
+    :param source_rows: A list of rows in the format returned by 
+        `source_row_at`.
+    :param should_cancel: If provided, a function that is called between beam
+        levels and scoring batches. If it returns True, the search stops and
+        returns the slices scored so far.
+    :param memory_budget: The approximate number of bytes of temporary masks
+        and scores to use when evaluating a batch of new slices (see
+        `auto_batch_size`).
+    :param ordinal_ranges: If True and the inputs are a ColumnarData, slices
+        are also expanded with ranges of consecutive values of its ordinal
+        columns that contain the source row's value.
+    
+    :return: A tuple (slices, row_use_counts) where slices is a list of the
+        scored slices found from any of the source rows, and row_use_counts is
+        the number of times each row was part of a scored slice.
+    """
+    if seen_slices is None: seen_slices = {}
+    if sps.issparse(inputs):
+        if positive_only == False:
+            raise ValueError("positive_only must be True or None for sparse matrices")
+        # Sparse rows share few candidates, so search from each row separately
+        all_slices = set()
+        row_use_counts = np.zeros(inputs.shape[0], dtype=np.int64)
+        for source_row in source_rows:
+            row_slices, row_counts = explore_groups_sparse(inputs, 
+                                                           score_fns, 
+                                                           source_row, 
+                                                           seen_slices=seen_slices, 
+                                                           group_filter=group_filter, 
+                                                           initial_slice=initial_slice,
+                                                           max_features=max_features, 
+                                                           min_items=min_items, 
+                                                           min_weight=min_weight, 
+                                                           max_weight=max_weight, 
+                                                           num_candidates=num_candidates,
+                                                           device=device,
+                                                           should_cancel=should_cancel,
+                                                           memory_budget=memory_budget)
+            all_slices |= set(row_slices)
+            row_use_counts += row_counts
+            if should_cancel is not None and should_cancel(): break
+        return list(all_slices), row_use_counts
+        
+    if initial_slice is None: initial_slice = IntersectionSlice([])
+    if num_candidates is not None:
+        # Maintain a ranking for each function separately, as different slices may
+        # maximize different functions
+        best_groups = [{fn_name: RankedList(num_candidates, [(initial_slice, -1e9)]) 
+                        for fn_name in score_fns}
+                       for _ in source_rows]
+    else:
+        best_groups = [set([initial_slice]) for _ in source_rows]
+    scored_slices = [set() for _ in source_rows]
+
+    mat_for_masks = inputs
+    if isinstance(mat_for_masks, ColumnarData):
+        input_columns = mat_for_masks.column_names
+    else:
+        input_columns = np.arange(mat_for_masks.shape[1])
+    compiled_filter = compile_filter(group_filter, input_columns) if group_filter is not None else None
+    # Positions, names and numbers of ordered values of the columns that can
+    # be expanded into ranges
+    range_columns = []
+    if ordinal_ranges and isinstance(mat_for_masks, ColumnarData):
+        range_columns = [(mat_for_masks.column_index[col], col, num_values) 
+                         for col, num_values in mat_for_masks.ordinal_columns.items()]
+    
+    univariate_masks = {}
+    # Bit-packed masks of the slices scored in the previous beam level, from
+    # which the masks of their subslices are derived
+    slice_masks = {}
+    # Slices that contain the same rows are equivalent, so only the first one
+    # found (which has the fewest features) is scored. Slices are identified
+    # by their size and a hash of their packed mask. Equivalence may be decided
+    # on a subsample of the rows, so it is only used within this batch and is
+    # not recorded in seen_slices
+    slice_fingerprints = {}
+    equivalent_slices = {}
+    
+    # Keep track of how many times each row has been used as part of a slice
+    row_use_counts = torch.zeros(mat_for_masks.shape[0], dtype=torch.long, device=device)
+    # Rows of collapsed inputs count as the number of rows they represent
+    row_weights = None
+    if isinstance(mat_for_masks, ColumnarData) and mat_for_masks.row_weights is not None:
+        row_weights = torch.from_numpy(mat_for_masks.row_weights).to(device)
+    batch_size = auto_batch_size(mat_for_masks.shape[0], len(score_fns), memory_budget)
+    
+    # Iterate over the columns max_features times
+    for col_size in range(max_features):
+        if should_cancel is not None and should_cancel(): break
+        # Candidate slices for each row's beam, and the features to score for
+        # each base slice across all rows
+        row_candidates = []
+        features_to_score = {}
+        pending_slices = set()
+        for row_idx, source_row in enumerate(source_rows):
+            if num_candidates is not None:
+                saved_groups = set([g for _, gset in best_groups[row_idx].items() for g in gset.items])
+            else:
+                saved_groups = set(g for g in best_groups[row_idx])
+            # Skip if only slicing using positive values and the row has a negative value
+            if positive_only:
+                row_columns = np.flatnonzero(np.asarray(source_row))
+            else:
+                row_columns = np.arange(len(input_columns))
+            candidates = []
+            for base_slice in saved_groups:
+                prescored_slices = []
+                new_slices = []
+                # Skip the features that the user wants to filter out
+                if compiled_filter is not None:
+                    allowed = compiled_filter.allowed_subslices(base_slice, np.asarray(source_row)[row_columns], row_columns)
+                    base_columns = row_columns[allowed]
+                else:
+                    base_columns = row_columns
+                features_to_add = [SliceFeature(input_columns[i], (source_row[i],)) for i in base_columns]
+                if range_columns:
+                    # A slice has at most one feature (value or range) per column
+                    slice_columns = set(f.feature_name for f in base_slice.univariate_features())
+                    features_to_add = [f for f in features_to_add if f.feature_name not in slice_columns]
+                    features_to_add += _range_features(source_row, range_columns, slice_columns, positive_only=positive_only)
+                for feature_to_add in features_to_add:
+                    # Skip if we've already looked at this column
+                    if feature_to_add in base_slice: continue
+                    
+                    new_slice = base_slice.subslice(feature_to_add)
+                    
+                    if new_slice in scored_slices[row_idx]: 
+                        continue
+                    if compiled_filter is not None:
+                        # Single values have already been checked against the
+                        # filter's value tables, but ranges have not
+                        slice_filter = compiled_filter.residual if len(feature_to_add.allowed_values) == 1 else compiled_filter
+                        if slice_filter is not None and not slice_filter(new_slice): 
+                            continue
+
+                    if new_slice in equivalent_slices:
+                        prescored_slices.append(new_slice)
+                    elif new_slice in seen_slices:
+                        if not seen_slices[new_slice]: continue
+                        prescored_slices.append(new_slice)
+                    else:
+                        new_slices.append(new_slice)
+                        if new_slice not in pending_slices:
+                            pending_slices.add(new_slice)
+                            features_to_score.setdefault(base_slice, []).append(feature_to_add)
+                candidates += prescored_slices + new_slices
+            row_candidates.append(candidates)
+            
+        # Score the union of the new candidate slices, grouped by base slice
+        parent_masks = slice_masks
+        slice_masks = {}
+        for base_slice, base_features in features_to_score.items():
+            if should_cancel is not None and should_cancel():
+                return list(set().union(*scored_slices)), row_use_counts.cpu().numpy()
+            if base_slice in parent_masks:
+                base_mask = _unpack_mask(parent_masks[base_slice], mat_for_masks.shape[0], device=device)
+            else:
+                base_mask = base_slice.make_mask(mat_for_masks, univariate_masks=univariate_masks, device=device)
+            base_support = (base_mask.sum() if row_weights is None else row_weights[base_mask].sum()).item()
+            
+            if isinstance(mat_for_masks, ColumnarData) and mat_for_masks.postings_index is not None:
+                # Drop features whose exact support, or whose intersection with
+                # the base slice computed from the postings, is too small
+                base_mask_np = base_mask.cpu().numpy()
+                supports = [_postings_support(mat_for_masks, f, base_mask_np) for f in base_features]
+                for f, support in zip(base_features, supports):
+                    if support < min_items: seen_slices[base_slice.subslice(f)] = None
+                base_features = [f for f, support in zip(base_features, supports) if support >= min_items]
+                
+            # Evaluate the new slices in chunks, so that the temporary masks
+            # fit in the memory budget however many features there are
+            for start_idx in range(0, len(base_features), batch_size):
+                if should_cancel is not None and should_cancel():
+                    return list(set().union(*scored_slices)), row_use_counts.cpu().numpy()
+                chunk_features = base_features[start_idx:start_idx + batch_size]
+                # Mask matrices are column-major, so that the scores of each
+                # slice are computed over contiguous memory
+                feature_masks = torch.stack([f.make_mask(mat_for_masks, univariate_masks=univariate_masks, device=device)
+                                             for f in chunk_features]).T
+                combined_masks = feature_masks & base_mask.unsqueeze(1)
+                new_scored_slices = [base_slice.subslice(f) for f in chunk_features]
+                    
+                # Remove slices that are too small, or that contain the same
+                # rows as the base slice or a slice that was already scored
+                if row_weights is None:
+                    slice_sizes = combined_masks.sum(0)
+                else:
+                    slice_sizes = (combined_masks * row_weights.unsqueeze(1)).sum(0)
+                slice_sizes = slice_sizes.cpu().numpy()
+                packed_masks = _pack_mask_columns(combined_masks)
+                large_enough = slice_sizes >= min_items
+                for i, s in enumerate(new_scored_slices):
+                    if not large_enough[i]:
+                        seen_slices[s] = None
+                        continue
+                    fingerprint = (slice_sizes[i], hash(packed_masks[i].tobytes()))
+                    if slice_sizes[i] == base_support:
+                        equivalent_slices[s] = base_slice
+                    elif fingerprint in slice_fingerprints:
+                        equivalent_slices[s] = slice_fingerprints[fingerprint]
+                    else:
+                        slice_fingerprints[fingerprint] = s
+                        continue
+                    large_enough[i] = False
+                packed_masks = [m for m, keep in zip(packed_masks, large_enough) if keep]
+                new_scored_slices = [s for s, keep in zip(new_scored_slices, large_enough) if keep]
+                if not new_scored_slices: continue
+                if not large_enough.all():
+                    keep_mask = torch.from_numpy(large_enough).to(device)
+                    # Select through the transpose to keep the matrices column-major
+                    combined_masks = combined_masks.T[keep_mask].T
+                    feature_masks = feature_masks.T[keep_mask].T
+                # The masks of the base slice's features are the same for every
+                # new slice, so they are broadcast instead of copied
+                itemized_masks = [f.make_mask(mat_for_masks, univariate_masks=univariate_masks, device=device).unsqueeze(1).expand(-1, len(new_scored_slices))
+                                  for f in base_slice.univariate_features()] + [feature_masks]
+                if col_size < max_features - 1:
+                    slice_masks.update(zip(new_scored_slices, packed_masks))
+    
+                row_use_counts += combined_masks.long().sum(1)
+                computed_scores = torch.zeros((len(score_fns), len(new_scored_slices))).to(device)
+                for i, (key, scorer) in enumerate(score_fns.items()):
+                    computed_scores[i] = scorer.calculate_score(new_scored_slices[-1], combined_masks, itemized_masks)
+                for i, new_slice in enumerate(new_scored_slices):
+                    seen_slices[new_slice] = {fn_name: score.item() for fn_name, score in zip(score_fns, computed_scores[:,i])}
+                
+        # Distribute the scores to the beam of each row
+        for row_idx, candidates in enumerate(row_candidates):
+            for new_slice in candidates:
+                new_slice = equivalent_slices.get(new_slice, new_slice)
+                if new_slice in scored_slices[row_idx]: continue
+                slice_scores = seen_slices.get(new_slice)
+                if not slice_scores: continue
+                new_slice = new_slice.rescore(slice_scores)
+                scored_slices[row_idx].add(new_slice)
+                if num_candidates is not None:
+                    for fn_name in score_fns:
+                        # Add to each ranking the score where only the current score
+                        # function's value is maximized
+                        score = sum((max_weight if f == fn_name else min_weight) * new_slice.score_values[f] for f in score_fns)
+                        best_groups[row_idx][fn_name].add(new_slice, score)
+                else:
+                    best_groups[row_idx].add(new_slice)
+                    
+        # Only the masks of slices that remain in a beam are needed
+        if num_candidates is not None:
+            beam_slices = set(g for row_groups in best_groups for ranking in row_groups.values() for g in ranking.items)
+        else:
+            beam_slices = set().union(*best_groups)
+        slice_masks = {s: m for s, m in slice_masks.items() if s in beam_slices}
+        
+    return list(set().union(*scored_slices)), row_use_counts.cpu().numpy()
 
 class SamplingSliceFinder:
     """
@@ -323,14 +873,31 @@ class SamplingSliceFinder:
                  max_weight=5.0,
                  similarity_threshold=0.9,
                  scoring_fraction=None, # None, 'auto', or number between 0 and 1
+                 num_subsamples=4,
                  show_progress=True,
                  progress_fn=None,
                  n_workers=None,
                  initial_slice=None,
                  discovery_mask=None,
+                 source_batch_size=8,
+                 deduplicate_sources=True,
+                 adaptive_sampling=False,
+                 rescore_top_k=None,
+                 rescore_confidence=0.95,
+                 memory_budget=None,
+                 ordinal_ranges=False,
                  device='cpu'):
         self.inputs = inputs
         self.raw_inputs = inputs.df if hasattr(inputs, 'df') else inputs
+        # Dense inputs of any type are converted once to a packed column store,
+        # which is used for all slice masks
+        self.columnar_inputs = ColumnarData.from_inputs(inputs)
+        # Collapsed inputs (see DiscretizedData.collapse) have one row per
+        # distinct row, and score functions are collapsed to match
+        self.row_weights = getattr(inputs, 'row_weights', None)
+        self.row_inverse = getattr(inputs, 'row_inverse', None)
+        if self.row_inverse is not None:
+            score_fns = collapse_score_functions(score_fns, self.row_inverse, len(self.row_weights))
         self.score_fns = score_fns
         self.source_mask = source_mask
         self.group_filter = group_filter
@@ -345,12 +912,38 @@ class SamplingSliceFinder:
         self.initial_slice = initial_slice
         self.similarity_threshold = similarity_threshold
         self.scoring_fraction = scoring_fraction
+        # Number of stratified row subsamples that beam searches rotate
+        # through when scoring_fraction is less than 1
+        self.num_subsamples = num_subsamples
+        self._subsamples = None
+        self._subsample_cache = {}
         self.device = device
+        # Number of sample rows whose beam searches are run together
+        self.source_batch_size = source_batch_size
+        # If True, each distinct source row is only searched from once
+        self.deduplicate_sources = deduplicate_sources
+        self._source_row_groups = None
+        # If True, source rows are drawn in favor of rows that are covered
+        # by few of the slices scored so far
+        self.adaptive_sampling = adaptive_sampling
+        # If set and slices are scored on subsamples, only the slices that may
+        # be in the top rescore_top_k for some score function (with the given
+        # confidence) are rescored on all of the discovery rows
+        self.rescore_top_k = rescore_top_k
+        self.rescore_confidence = rescore_confidence
+        # Approximate limit in bytes on the temporary memory used to evaluate
+        # each batch of slices (None for the default)
+        self.memory_budget = memory_budget
+        # If True, slices can also contain ranges of values of ordinal (e.g.
+        # binned) columns, in addition to single values
+        self.ordinal_ranges = ordinal_ranges
+        # Shared with worker processes so that running searches can stop early
+        self._cancel_flag = RawValue('b', 0)
         
         if n_workers is None: self.n_workers = max(1, os.cpu_count() // 2)
         else: self.n_workers = n_workers
         
-        self.explore_fn = explore_groups_beam_search
+        self.explore_fn = explore_groups_batch
         self.progress_fn = progress_fn
         if isinstance(self.raw_inputs, sps.csr_matrix):
             if self.raw_inputs.max() > 1:
@@ -368,13 +961,17 @@ class SamplingSliceFinder:
         else:
             self.discovery_mask = discovery_mask
         self.sampled_idxs = np.zeros(self.raw_inputs.shape[0], dtype=bool)
+        # Number of times each row has been part of a slice scored by the
+        # beam search, accumulated over calls to sample()
+        self.row_coverage = np.zeros(self.raw_inputs.shape[0], dtype=np.int64)
         self.results = RankedSliceList(list(set(self.all_scores)),
                             self.inputs,
                             self.score_fns,
                             eval_indexes=~self.discovery_mask if self.holdout_fraction > 0.0 else None,
                             min_weight=self.min_weight,
                             max_weight=self.max_weight,
-                            similarity_threshold=self.similarity_threshold)
+                            similarity_threshold=self.similarity_threshold,
+                            columnar=self.columnar_inputs)
         
     def copy_spec(self, inputs=None, score_fns=None, **kwargs):
         return SamplingSliceFinder(
@@ -396,23 +993,26 @@ class SamplingSliceFinder:
             n_workers=kwargs.get("n_workers", self.n_workers),
             initial_slice=kwargs.get("initial_slice", self.initial_slice),
             scoring_fraction=kwargs.get("scoring_fraction", self.scoring_fraction),
-            discovery_mask=kwargs.get("discovery_mask", self.discovery_mask)
+            num_subsamples=kwargs.get("num_subsamples", self.num_subsamples),
+            discovery_mask=kwargs.get("discovery_mask", self.discovery_mask),
+            source_batch_size=kwargs.get("source_batch_size", self.source_batch_size),
+            deduplicate_sources=kwargs.get("deduplicate_sources", self.deduplicate_sources),
+            adaptive_sampling=kwargs.get("adaptive_sampling", self.adaptive_sampling),
+            rescore_top_k=kwargs.get("rescore_top_k", self.rescore_top_k),
+            rescore_confidence=kwargs.get("rescore_confidence", self.rescore_confidence),
+            memory_budget=kwargs.get("memory_budget", self.memory_budget),
+            ordinal_ranges=kwargs.get("ordinal_ranges", self.ordinal_ranges)
         )
         
     def _create_worker_initializer(self, discovery_inputs, discovery_score_fns, sample_size=None):
         """
         Creates shared-memory arrays to store the input data and score function
-        data, specific to the input format (dataframe, array, or sparse array).
-        """
-        # Set up arrays for input dataframe
-        if isinstance(discovery_inputs, pd.DataFrame):
-            input_dtype = discovery_inputs[discovery_inputs.columns[0]].dtype
-            if not all(discovery_inputs[col].dtype == input_dtype for col in discovery_inputs.columns):
-                input_dtype = np.dtype('int32')
-            input_buf = RawArray(input_dtype.char, discovery_inputs.shape[0] * discovery_inputs.shape[1])
-            inputs_np = np.frombuffer(input_buf, dtype=input_dtype).reshape(discovery_inputs.shape)
-            np.copyto(inputs_np, discovery_inputs)
-        elif isinstance(discovery_inputs, sps.csr_matrix):
+        data, specific to the input format (columnar or sparse array).
+        """
+        # Set up arrays for input data
+        if isinstance(discovery_inputs, ColumnarData):
+            input_buf, input_spec = discovery_inputs.to_shared()
+        else:
             input_dtype = np.dtype(discovery_inputs.dtype)
             data_buf = RawArray(input_dtype.char, discovery_inputs.data.shape[0])
             data_np = np.frombuffer(data_buf, dtype=input_dtype)
@@ -424,59 +1024,44 @@ class SamplingSliceFinder:
             indptr_buf = RawArray(index_dtype.char, discovery_inputs.indptr.shape[0])
             indptr_np = np.frombuffer(indptr_buf, dtype=index_dtype)
             np.copyto(indptr_np, discovery_inputs.indptr)
-        else:
-            input_dtype = np.dtype(discovery_inputs.dtype)
-            input_buf = RawArray(input_dtype.char, discovery_inputs.shape[0] * discovery_inputs.shape[1])
-            inputs_np = np.frombuffer(input_buf, dtype=input_dtype).reshape(discovery_inputs.shape)
-            np.copyto(inputs_np, discovery_inputs)
             
         # Create score data
-        double_score_data = []
-        double_score_names = []
-        int_score_data = []
-        int_score_names = []
+        score_data = []
+        score_names = []
         score_dicts = {}
         for name, score_fn in discovery_score_fns.items():
             score_dicts[name] = score_fn.meta_dict()
             if score_fn.data is None: continue
-            if torch.is_floating_point(score_fn.data):
-                double_score_data.append(score_fn.data.cpu().numpy())
-                double_score_names.append(name)
-            else:
-                int_score_data.append(score_fn.data.cpu().numpy())
-                int_score_names.append(name)
-                
-        double_score_data_buf = RawArray(FLOAT_SCORE_DTYPE.char, discovery_inputs.shape[0] * len(double_score_names))
-        double_score_data_np = np.frombuffer(double_score_data_buf, dtype=FLOAT_SCORE_DTYPE).reshape((discovery_inputs.shape[0], len(double_score_names)))
-        for col in range(len(double_score_data)):
-            np.copyto(double_score_data_np[:,col], double_score_data[col])
-
-        int_score_data_buf = RawArray(INT_SCORE_DTYPE.char, discovery_inputs.shape[0] * len(int_score_names))
-        int_score_data_np = np.frombuffer(int_score_data_buf, dtype=INT_SCORE_DTYPE).reshape((discovery_inputs.shape[0], len(int_score_names)))
-        for col in range(len(int_score_data)):
-            np.copyto(int_score_data_np[:,col], int_score_data[col])
+            dtype = FLOAT_SCORE_DTYPE if torch.is_floating_point(score_fn.data) else INT_SCORE_DTYPE
+            score_data.append(score_fn.data.cpu().numpy().astype(dtype))
+            score_names.append(name)
+        score_data_buf, score_data_layout = shared_array_buffer(score_data)
+        
+        # Set up index arrays for the scoring subsamples
+        subsamples = self._scoring_subsamples(discovery_score_fns, 1 if sample_size is None else sample_size)
+        if subsamples is not None:
+            subsample_buf, subsample_layout = shared_array_buffer(subsamples)
+        else:
+            subsample_buf, subsample_layout = None, None
                         
         score_init_args = (
-            double_score_data_buf, 
-            (discovery_inputs.shape[0], len(double_score_names)), 
-            double_score_names, 
-            int_score_data_buf,
-            (discovery_inputs.shape[0], len(int_score_names)), 
-            int_score_names, 
+            score_data_buf,
+            score_data_layout,
+            score_names,
             score_dicts
         )
-        if isinstance(discovery_inputs, pd.DataFrame):
-            return init_worker_dataframe, (
-                input_buf, 
-                discovery_inputs.shape, 
-                input_dtype,
-                discovery_inputs.columns, 
-                1 if sample_size is None else sample_size, # sample size
+        if isinstance(discovery_inputs, ColumnarData):
+            return init_worker_columnar, (
+                input_buf,
+                input_spec,
+                subsample_buf,
+                subsample_layout,
                 self.device,
                 self.seen_slices,
+                self._cancel_flag,
                 *score_init_args
             )
-        elif isinstance(discovery_inputs, sps.csr_matrix):
+        else:
             return init_worker_sparse, (
                 data_buf,
                 indices_buf,
@@ -484,19 +1069,11 @@ class SamplingSliceFinder:
                 discovery_inputs.shape, 
                 input_dtype,
                 index_dtype,
-                1 if sample_size is None else sample_size, # sample size
-                self.device,
-                self.seen_slices,
-                *score_init_args
-            )
-        else:
-            return init_worker_array, (
-                input_buf, 
-                discovery_inputs.shape, 
-                input_dtype,
-                1 if sample_size is None else sample_size, # sample size
+                subsample_buf,
+                subsample_layout,
                 self.device,
                 self.seen_slices,
+                self._cancel_flag,
                 *score_init_args
             )
 
@@ -506,48 +1083,93 @@ class SamplingSliceFinder:
             yield item
         self.progress_fn(total, total)
     
-    def sample(self, num_samples):
+    def _draw_source_rows(self, num_samples):
         """
-        Runs the sampling slice finder for a set number of samples.
+        Chooses up to num_samples rows that have not been sampled yet, from
+        which to start beam searches. The rows are not marked as sampled (see
+        `_mark_sampled`).
         
-        :param num_samples: The number of samples to draw from the dataset
-        :return: All slices found so far in a RankedSliceList object
+        :param num_samples: The maximum number of rows to draw.
+        :return: An array of row indexes in the order they were drawn.
         """
+        source_weights = None
         if self.source_mask is not None:
             source_mask = (self.source_mask.values if isinstance(self.source_mask, pd.Series) else self.source_mask).copy()
+            if self.row_inverse is not None and len(source_mask) == len(self.row_inverse):
+                # Convert a source mask over the original rows to the number
+                # of source rows represented by each unique row
+                source_weights = np.bincount(self.row_inverse, weights=source_mask, minlength=len(self.row_weights))
+                source_mask = source_weights > 0
             source_mask &= self.discovery_mask
         else:
-            source_mask = self.discovery_mask
+            source_mask = self.discovery_mask.copy()
             
         source_mask &= ~self.sampled_idxs
-                    
-        # Use only score functions within the discovery subset of the data
-        discovery_score_fns = {fn_name: fn.subslice(self.discovery_mask)
-                            for fn_name, fn in self.score_fns.items()}
-        if isinstance(self.raw_inputs, (sps.csr_matrix, sps.csc_matrix)):
-            discovery_inputs = self.raw_inputs[self.discovery_mask].astype(np.uint8)
-        else:
-            if isinstance(self.raw_inputs, pd.DataFrame):
-                discovery_inputs = self.raw_inputs[self.discovery_mask].values.astype(np.uint8)
-            else:
-                discovery_inputs = self.raw_inputs[self.discovery_mask].astype(np.uint8)
-            discovery_inputs = torch.from_numpy(discovery_inputs).to(self.device)
         
         if self.initial_slice is not None:
-            initial_slice_mask = self.initial_slice.make_mask(self.raw_inputs).cpu().numpy()
+            mask_inputs = self.columnar_inputs if self.columnar_inputs is not None else self.raw_inputs
+            initial_slice_mask = self.initial_slice.make_mask(mask_inputs).cpu().numpy()
             source_mask &= initial_slice_mask
             if source_mask.sum() == 0:
                 raise ValueError("No samples can be taken from the intersection of the provided source mask and the initial slice")
         
         allowed_indexes = np.argwhere(source_mask).flatten()
-        sample_idxs = np.random.choice(allowed_indexes, 
-                                    size=min(len(allowed_indexes), num_samples), 
-                                    replace=False)
-        self.sampled_idxs[sample_idxs] = True
+        row_groups = None
+        if self.deduplicate_sources:
+            if self._source_row_groups is None:
+                self._source_row_groups = source_row_groups(self.columnar_inputs if self.columnar_inputs is not None else self.raw_inputs)
+            row_groups = self._source_row_groups
+        coverage = self.row_coverage[allowed_indexes]
+        if row_groups is not None:
+            # Sample distinct rows in proportion to the number of allowed rows
+            # that share their values, using one row from each group
+            _, first_idxs, group_inverse, weights = np.unique(row_groups[allowed_indexes], return_index=True, 
+                                                              return_inverse=True, return_counts=True)
+            candidate_idxs = allowed_indexes[first_idxs]
+            coverage = np.bincount(group_inverse.reshape(-1), weights=coverage, minlength=len(weights)) / weights
+        elif self.row_weights is not None:
+            # Sample unique rows in proportion to the number of rows they represent
+            candidate_idxs = allowed_indexes
+            weights = (source_weights if source_weights is not None else self.row_weights)[allowed_indexes]
+        else:
+            candidate_idxs = allowed_indexes
+            weights = None
+        if self.adaptive_sampling and coverage.any():
+            # Favor rows that are covered less often than average
+            coverage_weights = 1 / (1 + coverage / coverage.mean())
+            weights = coverage_weights if weights is None else weights * coverage_weights
+        if len(candidate_idxs) == 0:
+            return candidate_idxs
+        return np.random.choice(candidate_idxs, 
+                                size=min(len(candidate_idxs), num_samples), 
+                                replace=False,
+                                p=weights / weights.sum() if weights is not None else None)
+        
+    def _mark_sampled(self, sample_idxs, sampled=True):
+        """
+        Marks the given rows as sampled (or as not sampled if sampled is False),
+        together with any rows that are identical to them.
+        """
+        if self.deduplicate_sources and self._source_row_groups is not None:
+            # Rows identical to the sampled ones would repeat the same search
+            row_groups = self._source_row_groups
+            self.sampled_idxs[np.isin(row_groups, row_groups[sample_idxs])] = sampled
+        else:
+            self.sampled_idxs[sample_idxs] = sampled
             
-        sample_rows = [self.raw_inputs.iloc[sample_idx] 
-                if isinstance(self.raw_inputs, pd.DataFrame) else self.raw_inputs[sample_idx]
-                for sample_idx in sample_idxs]
+    def _prepare_discovery(self):
+        """
+        Returns a tuple (inputs, score_fns, sample_size) containing the inputs
+        and score functions restricted to the discovery rows, and the fraction
+        of these rows in which each beam search evaluates slices.
+        """
+        # Use only score functions within the discovery subset of the data
+        discovery_score_fns = {fn_name: fn.subslice(self.discovery_mask)
+                            for fn_name, fn in self.score_fns.items()}
+        if self.columnar_inputs is not None:
+            discovery_inputs = self.columnar_inputs if self.discovery_mask.all() else self.columnar_inputs[self.discovery_mask]
+        else:
+            discovery_inputs = self.raw_inputs[self.discovery_mask].astype(np.uint8)
             
         if str(self.scoring_fraction).lower() == 'auto':
             sample_size = min(10000 / discovery_inputs.shape[0], 1 / self.n_workers) # number of rows in which to evaluate each slice
@@ -555,66 +1177,151 @@ class SamplingSliceFinder:
             sample_size = 1.0
         else:
             sample_size = self.scoring_fraction
+        self._subsample_cache = {}
+        return discovery_inputs, discovery_score_fns, sample_size
+    
+    def _subsample_strata(self, discovery_score_fns):
+        """
+        Assigns each discovery row to a stratum defined by whether it is in
+        the source mask and by the outcome values of the score functions.
+        Outcomes with many distinct values are binned by quartile.
+        """
+        num_rows = int(self.discovery_mask.sum())
+        columns = []
+        if self.source_mask is not None:
+            source_mask = np.asarray(self.source_mask.values if isinstance(self.source_mask, pd.Series) else self.source_mask)
+            if self.row_inverse is not None and len(source_mask) == len(self.row_inverse):
+                source_mask = np.bincount(self.row_inverse, weights=source_mask, minlength=len(self.row_weights)) > 0
+            columns.append(source_mask[self.discovery_mask].astype(np.int64))
+        for score_fn in discovery_score_fns.values():
+            if score_fn.data is None or len(score_fn.data.shape) != 1: continue
+            data = score_fn.data.cpu().numpy().astype(np.float64)
+            present = ~np.isnan(data)
+            if len(np.unique(data[present])) > 10:
+                data = np.digitize(data, np.nanquantile(data, [0.25, 0.5, 0.75]))
+            columns.append(np.where(present, data, np.nanmax(data, initial=0) + 1))
+        if not columns:
+            return np.zeros(num_rows, dtype=np.int64)
+        _, strata = np.unique(np.stack(columns, 1), axis=0, return_inverse=True)
+        return strata.reshape(-1)
+    
+    def _scoring_subsamples(self, discovery_score_fns, sample_size):
+        """
+        Returns the list of stratified subsamples of the discovery rows (as
+        arrays of row positions) in which beam searches score slices, or None
+        if slices are scored on all rows. The subsamples are drawn on first
+        use and reused in later calls to `sample`.
+        """
+        if sample_size >= 1.0: return None
+        if self._subsamples is None:
+            self._subsamples = stratified_subsamples(self._subsample_strata(discovery_score_fns),
+                                                     sample_size,
+                                                     self.num_subsamples)
+        return self._subsamples
+    
+    def _batch_subsample(self, batch_id, sample_size):
+        """
+        Returns the id of the subsample used to score slices for the given
+        batch, rotating through the subsamples, or None if slices are scored
+        on all rows.
+        """
+        if sample_size >= 1.0: return None
+        return batch_id % self.num_subsamples
+    
+    def _source_batches(self, sample_idxs):
+        """
+        Returns the positions of the sampled rows within the discovery inputs,
+        grouped into batches that are searched together.
+        """
+        sample_positions = (np.cumsum(self.discovery_mask) - 1)[sample_idxs]
+        return [sample_positions[i:i + self.source_batch_size].tolist()
+                for i in range(0, len(sample_positions), self.source_batch_size)]
+    
+    def _create_pool(self, discovery_inputs, discovery_score_fns, sample_size, maxtasksperchild=10):
+        """
+        Creates a worker pool for the discovery inputs, and returns a tuple
+        (pool, worker) where worker runs the beam search for a batch of source
+        row positions.
+        """
+        init_fn, init_args = self._create_worker_initializer(discovery_inputs, discovery_score_fns, sample_size=sample_size)
         
-        best_groups = {fn_name: RankedList(self.final_num_candidates)
-                       for fn_name in discovery_score_fns}
-        if self.n_workers > 1:
-            worker_inputs = discovery_inputs.cpu().numpy() if isinstance(discovery_inputs, torch.Tensor) else discovery_inputs
-            init_fn, init_args = self._create_worker_initializer(worker_inputs, discovery_score_fns, sample_size=sample_size)
-            
-            worker = partial(explore_groups_worker, group_filter=self.group_filter,
-                                                    max_features=self.max_features,
-                                                    min_items=self.min_items * sample_size,
-                                                    initial_slice=self.initial_slice,
-                                                    num_candidates=self.num_candidates,
-                                                    min_weight=self.min_weight,
-                                                    max_weight=self.max_weight,
-                                                    device=self.device)
-            
-            pool = Pool(processes=self.n_workers, initializer=init_fn, initargs=init_args, maxtasksperchild=10)
-            bar = pool.imap_unordered(worker, sample_rows)
-            if self.show_progress: bar = tqdm.tqdm(bar, total=len(sample_rows))
-            if self.progress_fn is not None: bar = self._progress_fn_emitter(bar, len(sample_rows))
-            for results, _ in bar:
-                for fn_name in discovery_score_fns:
-                    for s in results:
-                        best_groups[fn_name].add(s, s.score_values[fn_name])
-
-            pool.close()
-            pool.join()
-            
+        worker = partial(explore_groups_worker, top_k=self.final_num_candidates,
+                                                group_filter=self.group_filter,
+                                                max_features=self.max_features,
+                                                min_items=self.min_items * sample_size,
+                                                initial_slice=self.initial_slice,
+                                                num_candidates=self.num_candidates,
+                                                min_weight=self.min_weight,
+                                                max_weight=self.max_weight,
+                                                device=self.device,
+                                                memory_budget=self.memory_budget,
+                                                ordinal_ranges=self.ordinal_ranges)
+        
+        pool = Pool(processes=self.n_workers, initializer=init_fn, initargs=init_args, maxtasksperchild=maxtasksperchild)
+        return pool, worker
+    
+    def _explore_batch(self, sample_batch, discovery_inputs, mask_inputs, discovery_score_fns, sample_size, subsample_id=None):
+        """
+        Runs the beam search for a batch of source row positions in the main
+        process.
+        
+        :return: A tuple (slices, used_rows, use_counts), where used_rows are
+            positions in the discovery inputs.
+        """
+        if subsample_id is not None:
+            if subsample_id not in self._subsample_cache:
+                rows = self._scoring_subsamples(discovery_score_fns, sample_size)[subsample_id]
+                self._subsample_cache[subsample_id] = (mask_inputs[rows], 
+                                                       {k: v.subslice(rows) for k, v in discovery_score_fns.items()})
+            worker_inputs, worker_score_fns = self._subsample_cache[subsample_id]
         else:
-            bar = tqdm.tqdm(sample_rows) if self.show_progress else sample_rows
-            if self.progress_fn is not None:
-                bar = self._progress_fn_emitter(bar, len(sample_rows))
-
-            for source_row in bar:
-                worker_sample = np.random.uniform(0.0, 1.0, size=discovery_inputs.shape[0]) <= sample_size
-                worker_inputs = discovery_inputs[worker_sample]
-                worker_score_fns = {k: v.subslice(worker_sample) for k, v in discovery_score_fns.items()}
+            worker_inputs = mask_inputs
+            worker_score_fns = discovery_score_fns
+        
+        sample_results, use_counts = self.explore_fn(worker_inputs,
+                                            worker_score_fns,
+                                            [source_row_at(discovery_inputs, i) for i in sample_batch],
+                                            seen_slices=self.seen_slices,
+                                            group_filter=self.group_filter,
+                                            max_features=self.max_features,
+                                            min_items=self.min_items * sample_size,
+                                            initial_slice=self.initial_slice,
+                                            num_candidates=self.num_candidates,
+                                            min_weight=self.min_weight,
+                                            max_weight=self.max_weight,
+                                            device=self.device,
+                                            should_cancel=self.cancelled,
+                                            memory_budget=self.memory_budget,
+                                            ordinal_ranges=self.ordinal_ranges)
+        used_rows = np.flatnonzero(use_counts)
+        use_counts = use_counts[used_rows]
+        if subsample_id is not None:
+            used_rows = self._subsamples[subsample_id][used_rows]
+        return sample_results, used_rows, use_counts
+    
+    def _add_batch_results(self, best_groups, results, used_rows, use_counts):
+        """
+        Adds the slices found by a beam search to the rankings for each score
+        function, and accumulates the coverage of the rows it used.
+        """
+        np.add.at(self.row_coverage, np.flatnonzero(self.discovery_mask)[used_rows], use_counts)
+        for fn_name, ranking in best_groups.items():
+            for s in results:
+                ranking.add(s, s.score_values[fn_name])
                 
-                sample_results, use_counts = self.explore_fn(worker_inputs,
-                                                    worker_score_fns,
-                                                    source_row,
-                                                    seen_slices=self.seen_slices,
-                                                    group_filter=self.group_filter,
-                                                    max_features=self.max_features,
-                                                    min_items=self.min_items * sample_size,
-                                                    initial_slice=self.initial_slice,
-                                                    num_candidates=self.num_candidates,
-                                                    min_weight=self.min_weight,
-                                                    max_weight=self.max_weight,
-                                                    device=self.device)
-                for fn_name in discovery_score_fns:
-                    for s in sample_results:
-                        best_groups[fn_name].add(s, s.score_values[fn_name])
-                    if sample_size == 1.0:
-                        self.seen_slices[s] = s.score_values
+    def _finish_sample(self, best_groups, discovery_inputs, discovery_score_fns, sample_size):
+        """
+        Scores the top slices collected in a round of sampling (on all of the
+        discovery rows, if beam searches ran on subsamples), adds them to the
+        results and updates the RankedSliceList.
+        """
         slices_to_score = set()
         for ranking in best_groups.values():
             slices_to_score |= set(ranking.items)
                 
         if sample_size < 1.0:
+            if self.rescore_top_k is not None:
+                slices_to_score = self._progressive_candidates(slices_to_score, discovery_inputs, discovery_score_fns, sample_size)
             print("Scoring collected slices", len(slices_to_score))
             univariate_masks = {}
             rescored_slices = score_slices_batch(slices_to_score,
@@ -623,7 +1330,8 @@ class SamplingSliceFinder:
                                                  self.max_features,
                                                  min_items=self.min_items,
                                                  device=self.device,
-                                                 univariate_masks=univariate_masks)
+                                                 univariate_masks=univariate_masks,
+                                                 memory_budget=self.memory_budget)
             
             for old_slice, new_slice in rescored_slices.items():
                 if new_slice is not None:
@@ -640,16 +1348,411 @@ class SamplingSliceFinder:
                 self.all_scores.append(new_slice)
                 self.seen_slices[new_slice] = new_slice.score_values
             
-            
-        self.results = RankedSliceList(list(set(self.all_scores)),
+        self.results = self._make_results(set(self.all_scores))
+        return self.results
+    
+    def _progressive_candidates(self, slices, discovery_inputs, discovery_score_fns, sample_size):
+        """
+        Narrows down the slices collected from beam searches on subsamples to
+        the ones that may be among the top `rescore_top_k` slices for some
+        score function. The slices are scored on progressively larger random
+        subsamples of the discovery rows, and a slice is dropped once the
+        upper confidence bound of each of its scores is below the k-th highest
+        lower confidence bound for that score. Score functions that cannot
+        estimate their error (see `ScoreFunctionBase.score_error`) keep all
+        slices.
+        
+        :return: A list of slices to score on all of the discovery rows.
+        """
+        z = NormalDist().inv_cdf((1 + self.rescore_confidence) / 2)
+        score_names = list(discovery_score_fns.keys())
+        candidates = list(slices)
+        fraction = sample_size
+        # Subsamples larger than a quarter of the rows cost about as much as
+        # rescoring on all of them
+        while fraction <= 0.25 and len(candidates) > self.rescore_top_k:
+            row_sample = np.random.uniform(0.0, 1.0, size=discovery_inputs.shape[0]) < fraction
+            score_errors = {}
+            scored = score_slices_batch(candidates,
+                                        discovery_inputs[row_sample],
+                                        {k: v.subslice(row_sample) for k, v in discovery_score_fns.items()},
+                                        self.max_features,
+                                        device=self.device,
+                                        univariate_masks={},
+                                        score_errors=score_errors,
+                                        memory_budget=self.memory_budget)
+            scores = np.array([[scored[s].score_values[name] if s in score_errors else np.nan for name in score_names]
+                               for s in candidates]).reshape(len(candidates), len(score_names))
+            errors = np.array([[score_errors[s][name] if s in score_errors else np.nan for name in score_names]
+                               for s in candidates]).reshape(len(candidates), len(score_names))
+            # The subsample is drawn without replacement from the discovery rows
+            widths = z * np.sqrt(1 - fraction) * np.where(np.isnan(errors), np.inf, errors)
+            lower = np.where(np.isnan(scores), -np.inf, scores - widths)
+            upper = np.where(np.isnan(scores), np.inf, scores + widths)
+            k = self.rescore_top_k
+            boundary = -np.partition(-lower, k - 1, axis=0)[k - 1]
+            keep = (upper >= boundary).any(1)
+            candidates = [s for s, keep_slice in zip(candidates, keep) if keep_slice]
+            fraction *= 4
+        return candidates
+    
+    def _make_results(self, slices):
+        """Creates a RankedSliceList for the given collection of slices."""
+        return RankedSliceList(list(slices),
                             self.inputs,
                             self.score_fns,
                             eval_indexes=~self.discovery_mask if self.holdout_fraction > 0.0 else None,
                             min_weight=self.min_weight,
                             max_weight=self.max_weight,
                             similarity_threshold=self.similarity_threshold,
-                            device=self.device)
-        return self.results, sample_idxs
+                            device=self.device,
+                            columnar=self.columnar_inputs)
+    
+    def cancel(self):
+        """
+        Cancels the sampling run in progress (e.g. from another thread). Beam
+        searches in the worker processes stop at the next beam level or
+        scoring batch, the pool is terminated, and the running sampling method
+        returns the results of the searches that completed before the
+        cancellation.
+        """
+        self._cancel_flag.value = 1
+        
+    def cancelled(self):
+        """Returns True if the current sampling run has been cancelled."""
+        return bool(self._cancel_flag.value)
+    
+    def sample(self, num_samples):
+        """
+        Runs the sampling slice finder for a set number of samples.
+        
+        :param num_samples: The number of samples to draw from the dataset
+        :return: All slices found so far in a RankedSliceList object
+        """
+        for results, sample_idxs in self.sample_iter(num_samples, snapshot_interval=None):
+            pass
+        return results, sample_idxs
+    
+    def sample_iter(self, num_samples, snapshot_interval=0.5):
+        """
+        Runs the sampling slice finder for a set number of samples, yielding
+        snapshots of the results while the beam searches complete. All
+        searches run in a single worker pool. 
+        
+        Snapshots contain the slices found in previous calls and the top
+        slices found so far in this run. If slices are scored on subsamples
+        (see `scoring_fraction`), the slices from this run have subsample
+        scores until the final result, in which they are rescored. If the
+        generator is closed before it is exhausted, the running searches are
+        abandoned and their source rows are not marked as sampled.
+        
+        :param num_samples: The number of samples to draw from the dataset
+        :param snapshot_interval: The minimum number of seconds between
+            snapshots. If None, only the final result is yielded.
+        :return: A generator of tuples (results, sample_idxs), where results
+            is a RankedSliceList and sample_idxs contains the rows whose
+            searches have completed. The last tuple contains the final
+            results, as returned by `sample`.
+        """
+        self._cancel_flag.value = 0
+        discovery_inputs, discovery_score_fns, sample_size = self._prepare_discovery()
+        sample_idxs = self._draw_source_rows(num_samples)
+        self._mark_sampled(sample_idxs)
+        sample_batches = self._source_batches(sample_idxs)
+        batch_idxs = [sample_idxs[i:i + self.source_batch_size] for i in range(0, len(sample_idxs), self.source_batch_size)]
+        
+        best_groups = {fn_name: RankedList(self.final_num_candidates)
+                       for fn_name in discovery_score_fns}
+        if self.n_workers > 1:
+            pool, worker = self._create_pool(discovery_inputs, discovery_score_fns, sample_size)
+            # Send batches of row indexes to the workers in chunks
+            chunk_size = max(1, len(sample_batches) // (self.n_workers * 4))
+            batch_results = pool.imap_unordered(partial(explore_groups_worker_indexed, worker),
+                                                ((batch_id, sample_batch, self._batch_subsample(batch_id, sample_size))
+                                                 for batch_id, sample_batch in enumerate(sample_batches)), 
+                                                chunksize=chunk_size)
+        else:
+            pool = None
+            # Column-major copy used to compute slice masks
+            mask_inputs = discovery_inputs.tocsc() if sps.issparse(discovery_inputs) else discovery_inputs
+            batch_results = ((batch_id, self._explore_batch(sample_batch, discovery_inputs, mask_inputs, 
+                                                            discovery_score_fns, sample_size,
+                                                            subsample_id=self._batch_subsample(batch_id, sample_size)))
+                             for batch_id, sample_batch in enumerate(sample_batches))
+        bar = tqdm.tqdm(batch_results, total=len(sample_batches)) if self.show_progress else batch_results
+        if self.progress_fn is not None:
+            bar = self._progress_fn_emitter(bar, len(sample_batches))
+            
+        completed_batches = []
+        last_snapshot = time.time()
+        try:
+            for batch_id, results in bar:
+                # Results that arrive after a cancellation may be incomplete
+                if self.cancelled(): break
+                if pool is not None:
+                    results, (used_rows, use_counts) = unpack_explore_results(results, self.initial_slice)
+                else:
+                    results, used_rows, use_counts = results
+                self._add_batch_results(best_groups, results, used_rows, use_counts)
+                completed_batches.append(batch_id)
+                
+                if (snapshot_interval is not None and len(completed_batches) < len(sample_batches) and
+                    time.time() - last_snapshot >= snapshot_interval):
+                    snapshot_slices = set(self.all_scores)
+                    for ranking in best_groups.values():
+                        snapshot_slices |= set(ranking.items)
+                    self.results = self._make_results(snapshot_slices)
+                    yield self.results, np.concatenate([batch_idxs[i] for i in completed_batches])
+                    last_snapshot = time.time()
+        finally:
+            finished = len(completed_batches) == len(sample_batches)
+            if pool is not None:
+                if finished: pool.close()
+                else: pool.terminate()
+                pool.join()
+            if not finished:
+                # Rows whose searches did not complete can be sampled again
+                completed = set(completed_batches)
+                for batch_id, idxs in enumerate(batch_idxs):
+                    if batch_id not in completed: self._mark_sampled(idxs, sampled=False)
+                sample_idxs = np.concatenate([batch_idxs[i] for i in completed_batches] + [np.zeros(0, dtype=np.int64)])
+            
+        yield self._finish_sample(best_groups, discovery_inputs, discovery_score_fns, sample_size), sample_idxs
+        
+    async def sample_async(self, num_samples, snapshot_interval=0.5):
+        """
+        Runs `sample_iter` in a background thread and yields its snapshots
+        asynchronously, so that an asyncio event loop is not blocked while
+        slices are found. Usage:
+        
+        ```
+        async for results, sample_idxs in finder.sample_async(100):
+            ...
+        ```
+        
+        :param num_samples: The number of samples to draw from the dataset
+        :param snapshot_interval: The minimum number of seconds between
+            snapshots. If None, only the final result is yielded.
+        :return: An asynchronous generator of tuples (results, sample_idxs)
+            as described in `sample_iter`.
+        """
+        loop = asyncio.get_running_loop()
+        snapshots = self.sample_iter(num_samples, snapshot_interval=snapshot_interval)
+        done = object()
+        try:
+            while True:
+                snapshot = await loop.run_in_executor(None, next, snapshots, done)
+                if snapshot is done: break
+                yield snapshot
+        finally:
+            try: snapshots.close()
+            except ValueError: pass # still running in the executor thread
+    
+    def sample_for(self, seconds, max_samples=None):
+        """
+        Runs the sampling slice finder until a time budget runs out. Source
+        rows are drawn and handed out to the workers one batch at a time, and
+        no new batches are started once the remaining time is less than the
+        time a batch is expected to take. When the deadline is reached,
+        batches that are still running are abandoned (their source rows are
+        not marked as sampled), so the results only include completed beam
+        searches. With a single worker, a batch that is running at the
+        deadline is finished.
+        
+        Note that if slices are scored on subsamples (see `scoring_fraction`),
+        the collected slices are rescored after the deadline.
+        
+        :param seconds: The time budget in seconds.
+        :param max_samples: If provided, the maximum number of samples to
+            draw.
+        :return: All slices found so far in a RankedSliceList object, and the
+            indexes of the rows whose beam searches were completed.
+        """
+        self._cancel_flag.value = 0
+        deadline = time.time() + seconds
+        start_time = time.time()
+        discovery_inputs, discovery_score_fns, sample_size = self._prepare_discovery()
+        best_groups = {fn_name: RankedList(self.final_num_candidates)
+                       for fn_name in discovery_score_fns}
+        
+        completed_idxs = []
+        pending_batches = []
+        num_drawn = 0
+        def next_batch():
+            # Draw source rows for a few batches at a time, so that rows
+            # that are never searched are not marked as sampled
+            nonlocal num_drawn
+            if not pending_batches:
+                num_to_draw = self.n_workers * self.source_batch_size * 2
+                if max_samples is not None: num_to_draw = min(num_to_draw, max_samples - num_drawn)
+                if num_to_draw <= 0: return None
+                sample_idxs = self._draw_source_rows(num_to_draw)
+                if len(sample_idxs) == 0: return None
+                num_drawn += len(sample_idxs)
+                for i in range(0, len(sample_idxs), self.source_batch_size):
+                    batch_idxs = sample_idxs[i:i + self.source_batch_size]
+                    pending_batches.append((batch_idxs, self._source_batches(batch_idxs)[0]))
+            batch_idxs, positions = pending_batches.pop(0)
+            self._mark_sampled(batch_idxs)
+            return batch_idxs, positions
+        
+        completion_times = [start_time]
+        def batch_seconds():
+            # Estimated time for one batch based on the recent throughput
+            num_recent = min(4, len(completion_times) - 1)
+            if num_recent == 0: return 0.0
+            return (completion_times[-1] - completion_times[-1 - num_recent]) * self.n_workers / num_recent
+        
+        if self.n_workers > 1:
+            # Batches are sent one at a time, so workers are not restarted
+            # after a fixed number of tasks
+            pool, worker = self._create_pool(discovery_inputs, discovery_score_fns, sample_size, maxtasksperchild=None)
+            finished = queue.Queue()
+            in_flight = {}
+            num_submitted = 0
+            try:
+                while True:
+                    # Hand out batches while they can be completed in time
+                    while (not self.cancelled() and len(in_flight) < self.n_workers * 2 and
+                           time.time() + batch_seconds() * (1 + len(in_flight) / self.n_workers) < deadline):
+                        batch = next_batch()
+                        if batch is None: break
+                        batch_id = num_submitted
+                        num_submitted += 1
+                        in_flight[batch_id] = batch[0]
+                        pool.apply_async(worker, (batch[1],), 
+                                         dict(subsample_id=self._batch_subsample(batch_id, sample_size)),
+                                         callback=partial(lambda i, r: finished.put((i, r)), batch_id),
+                                         error_callback=partial(lambda i, e: finished.put((i, e)), batch_id))
+                    if not in_flight: break
+                    try:
+                        batch_id, packed_results = finished.get(timeout=max(0.0, deadline - time.time()))
+                    except queue.Empty:
+                        break
+                    if isinstance(packed_results, Exception):
+                        raise packed_results
+                    if self.cancelled(): break
+                    results, (used_rows, use_counts) = unpack_explore_results(packed_results, self.initial_slice)
+                    self._add_batch_results(best_groups, results, used_rows, use_counts)
+                    completed_idxs.append(in_flight.pop(batch_id))
+                    completion_times.append(time.time())
+            finally:
+                if in_flight:
+                    # Abandon beam searches that could not finish in time
+                    pool.terminate()
+                    for batch_idxs in in_flight.values():
+                        self._mark_sampled(batch_idxs, sampled=False)
+                else:
+                    pool.close()
+                pool.join()
+        else:
+            # Column-major copy used to compute slice masks
+            mask_inputs = discovery_inputs.tocsc() if sps.issparse(discovery_inputs) else discovery_inputs
+            num_batches = 0
+            while time.time() + batch_seconds() < deadline and not self.cancelled():
+                batch = next_batch()
+                if batch is None: break
+                batch_results = self._explore_batch(batch[1], discovery_inputs, mask_inputs, discovery_score_fns, sample_size,
+                                                    subsample_id=self._batch_subsample(num_batches, sample_size))
+                num_batches += 1
+                if self.cancelled():
+                    self._mark_sampled(batch[0], sampled=False)
+                    break
+                self._add_batch_results(best_groups, *batch_results)
+                completed_idxs.append(batch[0])
+                completion_times.append(time.time())
+                
+        # Rows that were drawn but not handed out remain available
+        sample_idxs = np.concatenate(completed_idxs) if completed_idxs else np.zeros(0, dtype=np.int64)
+        return self._finish_sample(best_groups, discovery_inputs, discovery_score_fns, sample_size), sample_idxs
+    
+    def _top_slices(self, k):
+        """
+        Returns a dictionary mapping each score function name to a tuple
+        (slices, scores) containing the set of top k slices found so far for
+        that score function and an array of their scores. Slices with NaN
+        scores are not ranked.
+        """
+        result = {}
+        for fn_name in self.score_fns:
+            if not self.results.results:
+                result[fn_name] = (set(), np.zeros(0))
+                continue
+            scores = self.results.train_scores[fn_name].values
+            indexes = np.flatnonzero(~np.isnan(scores))
+            top_indexes = indexes[np.argsort(-scores[indexes], kind='stable')[:k]]
+            result[fn_name] = (set(self.results.results[i] for i in top_indexes), scores[top_indexes])
+        return result
+    
+    def sample_until_converged(self, max_samples, samples_per_round=None, top_k=10, min_overlap=0.9, score_tolerance=0.01, patience=2):
+        """
+        Runs the sampling slice finder in rounds until the top slices for each
+        score function stop changing, or until max_samples rows have been
+        sampled. After each round, the top_k slices for each score function
+        are compared to those of the previous round by their overlap (the
+        fraction of top slices that are shared) and by the relative change in
+        their mean score. The top slices are considered stable when the
+        overlap is at least min_overlap and the score change is at most
+        score_tolerance for every score function.
+        
+        :param max_samples: The maximum number of samples to draw.
+        :param samples_per_round: The number of samples to draw in each round.
+            If None, this is set to the larger of n_workers * source_batch_size
+            and one tenth of max_samples.
+        :param top_k: The number of top slices per score function to compare.
+        :param min_overlap: The minimum fraction of top slices that must be
+            shared with the previous round.
+        :param score_tolerance: The maximum relative change in the mean score
+            of the top slices compared to the previous round.
+        :param patience: The number of consecutive stable rounds after which
+            sampling stops.
+        :return: A tuple (results, trace), where results is a RankedSliceList
+            of all slices found so far, and trace is a list of dictionaries
+            describing each round (also available as the `convergence_trace`
+            attribute). Each dictionary contains the total number of samples
+            drawn, the overlap and score change for each score function, and
+            whether the round was stable.
+        """
+        if samples_per_round is None:
+            samples_per_round = max(self.n_workers * self.source_batch_size, max_samples // 10)
+        self.convergence_trace = []
+        previous_top = self._top_slices(top_k) if self.results.results else None
+        num_drawn = 0
+        stable_rounds = 0
+        while num_drawn < max_samples:
+            _, sample_idxs = self.sample(min(samples_per_round, max_samples - num_drawn))
+            num_drawn += len(sample_idxs)
+            current_top = self._top_slices(top_k)
+            overlaps = {}
+            score_deltas = {}
+            for fn_name, (top_slices, top_scores) in current_top.items():
+                if previous_top is None:
+                    overlaps[fn_name] = 0.0
+                    score_deltas[fn_name] = np.inf
+                    continue
+                previous_slices, previous_scores = previous_top[fn_name]
+                if top_slices or previous_slices:
+                    overlaps[fn_name] = len(top_slices & previous_slices) / max(len(top_slices), len(previous_slices))
+                else:
+                    overlaps[fn_name] = 1.0
+                if len(top_scores) and len(previous_scores):
+                    previous_mean = previous_scores.mean()
+                    score_deltas[fn_name] = float(abs(top_scores.mean() - previous_mean) / max(abs(previous_mean), 1e-9))
+                else:
+                    score_deltas[fn_name] = 0.0 if len(top_scores) == len(previous_scores) else np.inf
+            stable = all(overlaps[fn_name] >= min_overlap and score_deltas[fn_name] <= score_tolerance
+                         for fn_name in current_top)
+            stable_rounds = stable_rounds + 1 if stable else 0
+            self.convergence_trace.append({
+                "num_samples": num_drawn,
+                "overlap": overlaps,
+                "score_delta": score_deltas,
+                "stable": stable
+            })
+            previous_top = current_top
+            if stable_rounds >= patience or len(sample_idxs) == 0:
+                break
+        return self.results, self.convergence_trace
     
 def find_slices_by_sampling(inputs, 
                             score_fns, 
@@ -669,12 +1772,16 @@ def find_slices_by_sampling(inputs,
     Finds slices by sampling input rows and expanding slices that contain each
     sample row.
     
-    :param inputs: a dataframe or matrix representing the discretized inputs
+    :param inputs: a dataframe or matrix representing the discretized inputs,
+        or a DiscretizedData. If the DiscretizedData has been collapsed (see
+        `DiscretizedData.collapse`), each distinct row is searched once and
+        the score functions are collapsed to match.
     :param score_fns: a dictionary mapping score names to `ScoreFunction`-type
         objects
     :param source_mask: if provided, a boolean mask indicating which rows should
         be sampled from for slice finding. This will encourage finding slices
         that match a particular criterion of interest (e.g. model errors).
+        For collapsed inputs, the mask is over the original rows.
     :param group_filter: if provided, a function that takes a `Slice` object and
         returns False if the slice should not be explored. Subslices of these
         slices will not be explored either.
@@ -2,6 +2,52 @@ import numpy as np
 import torch
 from .utils import powerset
 
+def _group_sums(values, inverse, num_groups):
+    """
+    Sums the given values over groups of rows.
+    
+    :param values: A 1D tensor with one value per row.
+    :param inverse: A 1D tensor containing the group index of each row.
+    :param num_groups: The number of groups.
+    :return: A float64 tensor of length num_groups.
+    """
+    return torch.zeros(num_groups, dtype=torch.float64).index_add_(0, inverse, values.double().cpu())
+
+def _masked_sums(values, mask):
+    """Sums the given per-row values within each column of a mask matrix."""
+    return torch.nansum(values.unsqueeze(-1) * mask.view(mask.shape[0], -1), 0)
+
+def _rate_error(rate, count):
+    """
+    Estimates the standard error of a binary outcome rate measured on count
+    rows, smoothing the rate so that rates of zero or one have nonzero error.
+    """
+    smoothed = (rate * count + 1) / (count + 2)
+    return torch.sqrt((smoothed * (1 - smoothed)).clamp(min=0) / count)
+
+def collapse_score_functions(score_fns, inverse, num_groups):
+    """
+    Collapses a dictionary of score functions to operate on groups of
+    identical rows (see `DiscretizedData.collapse`). Score functions that are
+    already collapsed are returned unchanged, and score functions with one
+    value per group are expanded to the original rows before collapsing.
+    
+    :param score_fns: A dictionary of score function names to score functions.
+    :param inverse: An array containing the group index of each original row.
+    :param num_groups: The number of groups.
+    :return: A dictionary of collapsed score functions.
+    """
+    inverse = torch.as_tensor(inverse, dtype=torch.long)
+    result = {}
+    for name, fn in score_fns.items():
+        if fn.weights is not None:
+            result[name] = fn
+        elif fn.data is not None and len(fn.data) == num_groups and num_groups != len(inverse):
+            result[name] = fn.subslice(inverse).collapse(inverse, num_groups)
+        else:
+            result[name] = fn.collapse(inverse, num_groups)
+    return result
+
 class ScoreFunctionBase:
     """
     Base class for score functions that take as input a Slice object and a
@@ -13,15 +59,20 @@ class ScoreFunctionBase:
         :param score_type: A string that defines a score type like 'entropy', 
             'count'
         :param data: array that defines a particular outcome column. This can be
-            None if the score function does not require additional data.
+            None if the score function does not require additional data. For
+            collapsed score functions (see `collapse`), this is a 2D matrix of
+            statistics for each group of rows, where the first column contains
+            the number of rows in each group.
         """
         self.score_type = score_type
         if data is not None:
             assert isinstance(data, (np.ndarray, torch.Tensor)), "Score function data must be of type ndarray or Tensor"
-            assert len(data.shape) == 1, "Score function data must be 1D"
+            assert len(data.shape) in (1, 2), "Score function data must be 1D, or 2D for collapsed score functions"
             self.data = data if isinstance(data, torch.Tensor) else torch.from_numpy(data)
         else:
             self.data = None
+        # Number of original rows represented by each row, if collapsed
+        self.weights = self.data[:,0].float() if self.data is not None and len(self.data.shape) == 2 else None
         self.device = 'cpu'
 
     def calculate_score(self, slice, mask, univariate_masks):
@@ -36,6 +87,22 @@ class ScoreFunctionBase:
         """
 
         return 0.0
+    
+    def score_error(self, slice, mask, univariate_masks, scores):
+        """
+        Estimates the standard error of the scores for a batch of slices, if
+        the rows of the data are a uniform random sample from a larger
+        dataset. This is used to decide which slices scored on a subsample
+        need to be rescored on the full dataset.
+        
+        :param slice: a `Slice` object representing the feature values used to
+            determine the mask
+        :param mask: a boolean matrix where each column is the mask of a slice
+        :param scores: the scores computed by `calculate_score` for the mask
+        :return: a tensor of standard errors for each column of the mask, or
+            None if the score function cannot estimate its error.
+        """
+        return None
 
     def subslice(self, indexes):
         """
@@ -49,6 +116,40 @@ class ScoreFunctionBase:
         """
         return ScoreFunctionBase(self.score_type, self.data[indexes]).to(self.device)
     
+    def collapsed_statistics(self, inverse, num_groups):
+        """
+        Computes the matrix of statistics for each group of rows that is used
+        as the data of a collapsed score function. The first column contains
+        the number of rows in each group, and subclasses append the sums they
+        need to compute scores over groups.
+        
+        :param inverse: A tensor containing the group index of each row.
+        :param num_groups: The number of groups.
+        """
+        return _group_sums(torch.ones(len(inverse)), inverse, num_groups).unsqueeze(1)
+    
+    def collapse(self, inverse, num_groups):
+        """
+        Returns a score function of the same type that operates on groups of
+        identical rows. The scores of the collapsed function for a mask over
+        groups are the same as the scores of this function for the
+        corresponding mask over the original rows.
+        
+        :param inverse: An array or tensor containing the group index of each
+            row.
+        :param num_groups: The number of groups.
+        """
+        inverse = torch.as_tensor(inverse, dtype=torch.long)
+        stats = self.collapsed_statistics(inverse, num_groups)
+        return ScoreFunctionBase.from_dict(self.meta_dict(), stats)
+    
+    def _count(self, mask):
+        """Returns the number of original rows in each column of a mask matrix."""
+        mask = mask.view(mask.shape[0], -1)
+        if self.weights is None:
+            return mask.sum(0)
+        return _masked_sums(self.weights, mask)
+    
     def meta_dict(self):
         """A metadata dictionary for the score function, excluding the data."""
         base = {"type": type(self).__name__, "device": str(self.device)}
@@ -75,7 +176,7 @@ class EntropyScore(ScoreFunctionBase):
     slices with higher entropy or lower entropy using the `priority` parameter.
     """
 
-    def __init__(self, data, priority=None, eps=1e-6):
+    def __init__(self, data, priority=None, eps=1e-6, values=None):
         """
         :param data: the discrete or binned outcome data over which to calculate
             entropy
@@ -83,20 +184,33 @@ class EntropyScore(ScoreFunctionBase):
             inside the slice. If 'low', score for lower entropy (sharper
             distribution) inside the slice.
         :param eps: Small constant value to add to fractions
+        :param values: The unique outcome values, required if data is a
+            collapsed matrix of value counts.
         """
         super().__init__("entropy", data)
         assert priority in (None, "low", "high")
-        assert not torch.is_floating_point(self.data), "Entropy can only be calculated on integer inputs"
         self.priority = priority
         self.eps = eps
         
-        self._unique_vals = torch.unique(self.data)
-        self._val_one_hot = self.data.unsqueeze(-1) == self._unique_vals
-        self._base_entropy = self._calc_entropy(self.data)
+        if self.weights is not None:
+            # Counts of each unique value in each group of rows
+            self._unique_vals = torch.as_tensor(values)
+            self._val_one_hot = self.data[:,1:].float()
+            self._num_rows = self.weights.sum()
+            self._base_entropy = self._entropy_from_counts((self._val_one_hot.sum(0) * self._unique_vals).unsqueeze(-1))
+        else:
+            assert not torch.is_floating_point(self.data), "Entropy can only be calculated on integer inputs"
+            self._unique_vals = torch.unique(self.data)
+            self._val_one_hot = self.data.unsqueeze(-1) == self._unique_vals
+            self._num_rows = self.data.shape[0]
+            self._base_entropy = self._calc_entropy(self.data)
        
+    def _entropy_from_counts(self, counts):
+        return -torch.sum((counts / self._num_rows) * torch.log2(counts / self._num_rows), 0)
+        
     def _calc_entropy(self, mask):
         counts = (self._val_one_hot.unsqueeze(2).transpose(0, 1) * mask.view(mask.shape[0], -1)).transpose(0, 1).sum(0)
-        return -torch.sum((counts / self.data.shape[0]) * torch.log2(counts / self.data.shape[0]), 0)
+        return self._entropy_from_counts(counts)
 
     def high_entropy(self, mask):
         return (self.eps + self._calc_entropy(mask)) / (self.eps + self._base_entropy)
@@ -110,7 +224,11 @@ class EntropyScore(ScoreFunctionBase):
         return self.low_entropy(mask)
     
     def subslice(self, indexes):
-        return EntropyScore(self.data[indexes], priority=self.priority, eps=self.eps).to(self.device)
+        return EntropyScore(self.data[indexes], priority=self.priority, eps=self.eps, values=self._unique_vals).to(self.device)
+    
+    def collapsed_statistics(self, inverse, num_groups):
+        counts = [_group_sums((self.data == v).float(), inverse, num_groups) for v in self._unique_vals]
+        return torch.stack([super().collapsed_statistics(inverse, num_groups)[:,0], *counts], 1)
     
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count, univariate_masks):
         slice_hist = slice_hist[slice_hist > 0]
@@ -123,12 +241,12 @@ class EntropyScore(ScoreFunctionBase):
     
     def meta_dict(self):
         base = super().meta_dict()
-        base.update({"priority": self.priority, "eps": self.eps})
+        base.update({"priority": self.priority, "eps": self.eps, "values": self._unique_vals.tolist()})
         return base
     
     @classmethod
     def from_dict(cls, meta_dict, data):
-        return EntropyScore(data, priority=meta_dict["priority"], eps=meta_dict["eps"])
+        return EntropyScore(data, priority=meta_dict["priority"], eps=meta_dict["eps"], values=meta_dict.get("values"))
     
 def _nanvar(tensor, dim=None, keepdim=False):
     tensor_mean = tensor.nanmean(dim=dim, keepdim=True)
@@ -140,6 +258,21 @@ def _nanstd(tensor, dim=None, keepdim=False):
     output = output.sqrt()
     return output
 
+def _outcome_statistics(score_fn, inverse, num_groups):
+    """
+    Returns collapsed statistics for a score function with a continuous
+    outcome: the number of rows, the sum of present outcome values, the number
+    of present values, and the sum of squared values in each group.
+    """
+    present = ~torch.isnan(score_fn.data)
+    values = torch.where(present, score_fn.data, torch.zeros_like(score_fn.data))
+    return torch.stack([
+        _group_sums(torch.ones(len(inverse)), inverse, num_groups),
+        _group_sums(values, inverse, num_groups),
+        _group_sums(present.float(), inverse, num_groups),
+        _group_sums(values.double() ** 2, inverse, num_groups),
+    ], 1)
+
 class MeanDifferenceScore(ScoreFunctionBase):
     """
     A score function that returns higher values when the absolute difference in
@@ -149,18 +282,43 @@ class MeanDifferenceScore(ScoreFunctionBase):
     def __init__(self, data):
         super().__init__("mean", data)
         self.data = self.data.float()
-        self._std = _nanstd(self.data)
-        self._mean = torch.nanmean(self.data)
+        if self.weights is not None:
+            total_sum, total_present, total_sq = self.data[:,1:4].double().sum(0)
+            self._sums = self.data[:,1]
+            self._num_present = total_present.float()
+            self._mean = (total_sum / total_present).float()
+            self._std = (total_sq / total_present - (total_sum / total_present) ** 2).clamp(min=0).sqrt().float()
+        else:
+            self._std = _nanstd(self.data)
+            self._mean = torch.nanmean(self.data)
         
     def calculate_score(self, slice, mask, univariate_masks):
+        if self.weights is not None:
+            return torch.abs(_masked_sums(self._sums, mask) / self._num_present - self._mean) / self._std
         return torch.abs((self.data.unsqueeze(-1) * mask.view(mask.shape[0], -1)).nanmean(0) - self._mean) / self._std
     
+    def score_error(self, slice, mask, univariate_masks, scores):
+        if self.weights is not None:
+            count = _masked_sums(self.data[:,2], mask)
+            mask_mean = _masked_sums(self._sums, mask) / count
+            mask_sq = _masked_sums(self.data[:,3], mask) / count
+        else:
+            present = ~torch.isnan(self.data)
+            values = torch.where(present, self.data, torch.zeros_like(self.data))
+            count = _masked_sums(present.float(), mask)
+            mask_mean = _masked_sums(values, mask) / count
+            mask_sq = _masked_sums(values ** 2, mask) / count
+        return torch.sqrt((mask_sq - mask_mean ** 2).clamp(min=0) / count) / self._std
+    
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count, univariate_masks):
         return np.abs(slice_sum / slice_count - self._mean) / self._std
         
     def subslice(self, indexes):
         return MeanDifferenceScore(self.data[indexes]).to(self.device)
     
+    def collapsed_statistics(self, inverse, num_groups):
+        return _outcome_statistics(self, inverse, num_groups)
+    
     def meta_dict(self):
         base = super().meta_dict()
         return base
@@ -176,28 +334,44 @@ class SliceSizeScore(ScoreFunctionBase):
     centered around a given fraction of the dataset.
     """
 
-    def __init__(self, ideal_fraction=0.25, spread=0.2):
+    def __init__(self, ideal_fraction=0.25, spread=0.2, data=None):
         """
         :param ideal_fraction: The fraction of the dataset that a slice should
             span to receive the highest score.
         :param spread: The standard deviation of the Gaussian curve, which
             determines how sharply slice sizes are penalized away from the
             ideal_fraction.
+        :param data: If provided, a collapsed matrix containing the number of
+            rows in each group.
         """
-        super().__init__("slice_size")
+        super().__init__("slice_size", data)
         self.ideal_fraction = ideal_fraction
         self.spread = spread
 
     def calculate_score(self, slice, mask, univariate_masks):
-        frac = mask.sum(0) / mask.shape[0]
+        if self.weights is not None:
+            frac = self._count(mask) / self.weights.sum()
+        else:
+            frac = mask.sum(0) / mask.shape[0]
         return torch.exp(-0.5 * ((frac - self.ideal_fraction) / self.spread) ** 2)
+    
+    def score_error(self, slice, mask, univariate_masks, scores):
+        if self.weights is not None:
+            total = self.weights.sum()
+            frac = self._count(mask) / total
+        else:
+            total = mask.shape[0]
+            frac = mask.sum(0) / total
+        frac_error = torch.sqrt((frac * (1 - frac)).clamp(min=0) / total)
+        return scores * torch.abs(frac - self.ideal_fraction) / self.spread ** 2 * frac_error
         
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count, univariate_masks):
         frac = slice_count / total_count
         return np.exp(-0.5 * ((frac - self.ideal_fraction) / self.spread) ** 2)
     
     def subslice(self, indexes):
-        return SliceSizeScore(ideal_fraction=self.ideal_fraction, spread=self.spread).to(self.device)
+        data = self.data[indexes] if self.data is not None else None
+        return SliceSizeScore(ideal_fraction=self.ideal_fraction, spread=self.spread, data=data).to(self.device)
 
     def meta_dict(self):
         base = super().meta_dict()
@@ -206,7 +380,7 @@ class SliceSizeScore(ScoreFunctionBase):
     
     @classmethod
     def from_dict(cls, meta_dict, data):
-        return SliceSizeScore(ideal_fraction=meta_dict["ideal_fraction"], spread=meta_dict["spread"])
+        return SliceSizeScore(ideal_fraction=meta_dict["ideal_fraction"], spread=meta_dict["spread"], data=data)
     
 
 class NumFeaturesScore(ScoreFunctionBase):
@@ -221,6 +395,10 @@ class NumFeaturesScore(ScoreFunctionBase):
     def calculate_score(self, slice, mask, univariate_masks):
         return 1 / (1 + np.log2(1 + slice.feature.num_univariate_features))
     
+    def score_error(self, slice, mask, univariate_masks, scores):
+        # The score does not depend on the rows in the slice
+        return torch.zeros(mask.view(mask.shape[0], -1).shape[1]).to(self.device)
+    
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count, univariate_masks):
         return self.calculate_score(slice, None, univariate_masks)
     
@@ -253,15 +431,33 @@ class OutcomeRateScore(ScoreFunctionBase):
         self.data = self.data.float()
         self.inverse = inverse
         self.eps = eps
-        self._mean = torch.nanmean(self.data)
-        self._present_mask = ~torch.isnan(self.data)
+        if self.weights is not None:
+            self._sums, self._present_counts = self.data[:,1], self.data[:,2]
+            self._mean = self._sums.sum() / self._present_counts.sum()
+        else:
+            self._mean = torch.nanmean(self.data)
+            self._present_mask = ~torch.isnan(self.data)
         
     def calculate_score(self, slice, mask, univariate_masks):
         mask = mask.view(mask.shape[0], -1)
-        mask_mean = torch.nansum(self.data.unsqueeze(-1) * mask, 0) / torch.logical_and(mask, self._present_mask.unsqueeze(-1)).sum(0)
+        if self.weights is not None:
+            mask_mean = _masked_sums(self._sums, mask) / _masked_sums(self._present_counts, mask)
+        else:
+            mask_mean = torch.nansum(self.data.unsqueeze(-1) * mask, 0) / torch.logical_and(mask, self._present_mask.unsqueeze(-1)).sum(0)
         if self.inverse: 
             return (self.eps + self._mean) / (self.eps + mask_mean)
         return (self.eps + mask_mean) / (self.eps + self._mean)
+    
+    def score_error(self, slice, mask, univariate_masks, scores):
+        mask = mask.view(mask.shape[0], -1)
+        if self.weights is not None:
+            count = _masked_sums(self._present_counts, mask)
+            mask_mean = _masked_sums(self._sums, mask) / count
+        else:
+            count = torch.logical_and(mask, self._present_mask.unsqueeze(-1)).sum(0)
+            mask_mean = torch.nansum(self.data.unsqueeze(-1) * mask, 0) / count
+        # The relative error of the score is that of the rate in the slice
+        return scores * _rate_error(mask_mean, count) / (self.eps + mask_mean)
 
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count, univariate_masks):
         mean = slice_sum / slice_count
@@ -271,6 +467,9 @@ class OutcomeRateScore(ScoreFunctionBase):
     
     def subslice(self, indexes):
         return OutcomeRateScore(self.data[indexes], inverse=self.inverse, eps=self.eps).to(self.device)
+    
+    def collapsed_statistics(self, inverse, num_groups):
+        return _outcome_statistics(self, inverse, num_groups)[:,:3]
 
     def meta_dict(self):
         base = super().meta_dict()
@@ -296,16 +495,23 @@ class OutcomeShareScore(ScoreFunctionBase):
         """
         super().__init__("outcome_share", data)
         self.data = self.data.float()
-        self._sum = torch.nansum(self.data)
+        self._sums = self.data[:,1] if self.weights is not None else self.data
+        self._sum = torch.nansum(self._sums)
         
     def calculate_score(self, slice, mask, univariate_masks):
-        return torch.nansum(self.data.unsqueeze(-1) * mask.view(mask.shape[0], -1), 0) / self._sum
+        return _masked_sums(self._sums, mask) / self._sum
+    
+    def score_error(self, slice, mask, univariate_masks, scores):
+        return torch.sqrt((scores * (1 - scores)).clamp(min=0) / self._sum)
 
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count, univariate_masks):
         return slice_sum / self._sum
     
     def subslice(self, indexes):
         return OutcomeShareScore(self.data[indexes]).to(self.device)
+    
+    def collapsed_statistics(self, inverse, num_groups):
+        return _outcome_statistics(self, inverse, num_groups)[:,:2]
 
     def meta_dict(self):
         base = super().meta_dict()
@@ -354,17 +560,26 @@ class InteractionEffectScore(ScoreFunctionBase):
     def __init__(self, data, eps=1e-6):
         super().__init__("interaction_effect", data)
         self.data = self.data.float()
-        self._mean = torch.nanmean(self.data)
         self.eps = eps
-        self._present_mask = ~torch.isnan(self.data)
+        if self.weights is not None:
+            self._sums, self._present_counts = self.data[:,1], self.data[:,2]
+            self._mean = self._sums.sum() / self._present_counts.sum()
+        else:
+            self._mean = torch.nanmean(self.data)
+            self._present_mask = ~torch.isnan(self.data)
+        
+    def _masked_mean(self, mask):
+        mask = mask.view(mask.shape[0], -1)
+        if self.weights is not None:
+            return _masked_sums(self._sums, mask) / _masked_sums(self._present_counts, mask)
+        return torch.nansum(self.data.unsqueeze(-1) * mask, 0) / torch.logical_and(mask, self._present_mask.unsqueeze(-1)).sum(0)
         
     def _superslice_score(self, masks):
         overall_mask = None
         for m in masks:
             if overall_mask is None: overall_mask = m.view(m.shape[0], -1)
             else: overall_mask = torch.logical_and(overall_mask, m.view(m.shape[0], -1))
-        return (self.eps + torch.nansum(self.data.unsqueeze(-1) * overall_mask.view(overall_mask.shape[0], -1), 0) / 
-                torch.logical_and(overall_mask, self._present_mask.unsqueeze(-1)).sum(0)) / (self.eps + self._mean)
+        return (self.eps + self._masked_mean(overall_mask)) / (self.eps + self._mean)
 
     def calculate_score(self, slice, mask, univariate_masks):
         # if len(univariate_masks) <= 1: return torch.ones(mask.view(mask.shape[0], -1).shape[1]).to(self.device)
@@ -383,11 +598,23 @@ class InteractionEffectScore(ScoreFunctionBase):
         if len(univariate_masks) <= 1: return torch.ones(mask.view(mask.shape[0], -1).shape[1]).to(self.device)
         mask = mask.view(mask.shape[0], -1)
         overall_effect = torch.maximum(torch.tensor(0).to(self.device), 
-                                       ((self.eps + torch.nansum(self.data.unsqueeze(-1) * mask, 0) / torch.logical_and(mask, self._present_mask.unsqueeze(-1)).sum(0)) / (self.eps + self._mean)))
+                                       ((self.eps + self._masked_mean(mask)) / (self.eps + self._mean)))
         itemized_effect = torch.stack([self._superslice_score(ms)
                     for ms in powerset(univariate_masks) if len(ms) > 0 and len(ms) < len(univariate_masks)]).max(0).values
         return torch.maximum(torch.tensor(0).to(self.device), overall_effect / itemized_effect)
     
+    def score_error(self, slice, mask, univariate_masks, scores):
+        mask = mask.view(mask.shape[0], -1)
+        if len(univariate_masks) <= 1: return torch.zeros(mask.shape[1]).to(self.device)
+        if self.weights is not None:
+            count = _masked_sums(self._present_counts, mask)
+        else:
+            count = torch.logical_and(mask, self._present_mask.unsqueeze(-1)).sum(0)
+        mask_mean = self._masked_mean(mask)
+        # Superslices are larger than the slice, so the error of the score is
+        # dominated by the error of the outcome rate in the slice itself
+        return scores * _rate_error(mask_mean, count) / (self.eps + mask_mean)
+    
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count, univariate_masks):
         if len(univariate_masks) <= 1: return 1.0
         overall_effect = max(0, ((self.eps + slice_sum / slice_count) / (self.eps + self._mean)))
@@ -398,6 +625,9 @@ class InteractionEffectScore(ScoreFunctionBase):
     
     def subslice(self, indexes):
         return InteractionEffectScore(self.data[indexes]).to(self.device)
+    
+    def collapsed_statistics(self, inverse, num_groups):
+        return _outcome_statistics(self, inverse, num_groups)[:,:3]
 
     def meta_dict(self):
         base = super().meta_dict()
@@ -428,14 +658,23 @@ class SliceSimilarityScore(ScoreFunctionBase):
         self.metric = metric
         
     def calculate_score(self, slice, mask, univariate_masks):
-        intersect = (mask.view(mask.shape[0], -1) * self.data.unsqueeze(-1) > 0).sum(0)
-        if self.metric == 'jaccard':
+        if self.weights is not None:
+            # Number of rows in each group that are in the reference slice
+            mask = mask.view(mask.shape[0], -1)
+            reference_counts = self.data[:,1]
+            intersect = _masked_sums(reference_counts, mask)
+            union = _masked_sums(self.weights, mask) + _masked_sums(reference_counts, ~mask)
+            reference_sum = self.data[:,2].sum(0)
+        else:
+            intersect = (mask.view(mask.shape[0], -1) * self.data.unsqueeze(-1) > 0).sum(0)
             union = (mask.view(mask.shape[0], -1) + self.data.unsqueeze(-1) > 0).sum(0)
+            reference_sum = self.data.sum(0)
+        if self.metric == 'jaccard':
             return intersect / union
         elif self.metric == 'subslice':
-            return intersect / mask.sum(0)
+            return intersect / self._count(mask)
         elif self.metric == 'superslice':
-            return intersect / self.data.sum(0)
+            return intersect / reference_sum
         raise AttributeError(f"Unsupported metric {self.metric}")
     
     def calculate_score_fast(self, slice, slice_sum, slice_hist, slice_count, total_count):
@@ -443,6 +682,13 @@ class SliceSimilarityScore(ScoreFunctionBase):
     
     def subslice(self, indexes):
         return SliceSimilarityScore(self.data[indexes], metric=self.metric).to(self.device)
+    
+    def collapsed_statistics(self, inverse, num_groups):
+        return torch.stack([
+            _group_sums(torch.ones(len(inverse)), inverse, num_groups),
+            _group_sums((self.data > 0).float(), inverse, num_groups),
+            _group_sums(self.data, inverse, num_groups),
+        ], 1)
 
     def meta_dict(self):
         base = super().meta_dict()
@@ -2,11 +2,27 @@ import scipy.sparse as sps
 from scipy.sparse import csr_matrix, csc_matrix
 import numpy as np
 import pandas as pd
-from .utils import pairwise_jaccard_similarities, detect_data_type, convert_to_native_types, powerset
+from .utils import pairwise_jaccard_similarities, detect_data_type, convert_to_native_types, powerset, auto_batch_size, MaskCache
 from .discretization import DiscretizedData
+from .columnar import ColumnarData
 import torch
 import collections
 
+def sparse_column_mask(inputs, col, values):
+    """
+    Returns a boolean mask of the rows in which a column of a CSC matrix has
+    one of the given values, using the stored entries of that column only.
+    """
+    start, end = inputs.indptr[col], inputs.indptr[col + 1]
+    rows, data = inputs.indices[start:end], inputs.data[start:end]
+    if 0 in values:
+        mask = np.ones(inputs.shape[0], dtype=bool)
+        mask[rows[~np.isin(data, values)]] = False
+    else:
+        mask = np.zeros(inputs.shape[0], dtype=bool)
+        mask[rows[np.isin(data, values)]] = True
+    return mask
+
 class SliceFeatureBase:
     def __init__(self):
         self.empty = True
@@ -104,9 +120,17 @@ class SliceFeature(SliceFeatureBase):
         if univariate_masks is not None:
             univ_mask = univariate_masks.get(self, None)
             
-        if univ_mask is None:
+        if univ_mask is None and isinstance(inputs, ColumnarData):
+            univ_mask = torch.from_numpy(inputs.column_mask(self.feature_name, self.allowed_values)).to(device)
+            if univariate_masks is not None:
+                univariate_masks[self] = univ_mask
+        elif univ_mask is None and isinstance(inputs, (sps.csc_matrix, sps.csc_array)):
+            univ_mask = torch.from_numpy(sparse_column_mask(inputs, self.feature_name, self.allowed_values)).to(device)
+            if univariate_masks is not None:
+                univariate_masks[self] = univ_mask
+        elif univ_mask is None:
             for val in self.allowed_values:
-                if isinstance(inputs, (sps.csc_matrix, sps.csc_array, sps.csr_matrix, sps.csr_array)):
+                if isinstance(inputs, (sps.csr_matrix, sps.csr_array)):
                     mask = torch.from_numpy((inputs[:,self.feature_name] == val).toarray().flatten()).to(device)
                 elif isinstance(inputs, np.ndarray):
                     mask = torch.from_numpy(inputs[:,self.feature_name] == val).to(device)
@@ -133,7 +157,7 @@ class SliceFeatureNegation(SliceFeatureBase):
         self.num_univariate_features = self.feature.num_univariate_features
         
     def make_mask(self, inputs, univariate_masks=None, device='cpu'):
-        return ~self.feature.make_mask(inputs, univariate_masks=univariate_masks, device='cpu')
+        return ~self.feature.make_mask(inputs, univariate_masks=univariate_masks, device=device)
     
     def univariate_features(self):
         return self.feature.univariate_features()
@@ -168,8 +192,8 @@ class SliceFeatureAnd(SliceFeatureBase):
         self.num_univariate_features = self.lhs.num_univariate_features + self.rhs.num_univariate_features
         
     def make_mask(self, inputs, univariate_masks=None, device='cpu'):
-        return (self.lhs.make_mask(inputs, univariate_masks=univariate_masks, device='cpu') & 
-                self.rhs.make_mask(inputs, univariate_masks=univariate_masks, device='cpu'))
+        return (self.lhs.make_mask(inputs, univariate_masks=univariate_masks, device=device) & 
+                self.rhs.make_mask(inputs, univariate_masks=univariate_masks, device=device))
 
     def univariate_features(self):
         return (*self.lhs.univariate_features(), *self.rhs.univariate_features())
@@ -205,8 +229,8 @@ class SliceFeatureOr(SliceFeatureBase):
         self.num_univariate_features = self.lhs.num_univariate_features + self.rhs.num_univariate_features
         
     def make_mask(self, inputs, univariate_masks=None, device='cpu'):
-        return (self.lhs.make_mask(inputs, univariate_masks=univariate_masks, device='cpu') |
-                self.rhs.make_mask(inputs, univariate_masks=univariate_masks, device='cpu'))
+        return (self.lhs.make_mask(inputs, univariate_masks=univariate_masks, device=device) |
+                self.rhs.make_mask(inputs, univariate_masks=univariate_masks, device=device))
 
     def univariate_features(self):
         return (*self.lhs.univariate_features(), *self.rhs.univariate_features())
@@ -358,41 +382,210 @@ class IntersectionSlice(Slice):
         """
         return IntersectionSlice(self.base_features, new_scores)
 
-def score_slices_batch(slices_to_score, inputs, score_fns, max_features, min_items=None, device='cpu', univariate_masks=None):
+def conjunction_features(feature):
+    """
+    Returns a list of the SliceFeatures that are AND'ed together to form the
+    given slice feature, or None if the feature contains other operations.
+    """
+    if isinstance(feature, SliceFeature):
+        return [feature]
+    elif isinstance(feature, SliceFeatureAnd):
+        lhs = conjunction_features(feature.lhs)
+        rhs = conjunction_features(feature.rhs)
+        if lhs is None or rhs is None: return None
+        return lhs + rhs
+    elif type(feature) is SliceFeatureBase:
+        return []
+    return None
+
+class SliceMaskPlan:
+    """
+    A flat plan for evaluating the masks of a set of slice features in one
+    pass. Each distinct subexpression is evaluated once, no matter how many of
+    the features contain it: conjunctions are flattened and their operands
+    sorted, so that the masks of slices that share features are built on the
+    same chain of intersections (e.g. `a & b` is computed once for the slices
+    `a & b & c` and `a & b & d`). Intermediate masks are released as soon as
+    the plan no longer needs them.
+    
+    Nodes are keyed by their structure (a conjunction by the set of its
+    operands), so the masks of intermediate nodes can also be kept in a
+    cache that outlives the plan and reused by later plans.
+    """
+    def __init__(self, features):
+        """
+        :param features: A list of `SliceFeatureBase` objects (or `Slice`
+            objects) whose masks should be computed.
+        """
+        super().__init__()
+        # Each node is a tuple (operation, arguments), where the arguments of
+        # logical operations are the ids of earlier nodes. node_keys contains
+        # the structural key of each node
+        self.nodes = []
+        self.node_keys = []
+        self.node_ids = {}
+        self.outputs = [self._compile(f.feature if isinstance(f, Slice) else f) for f in features]
+        
+        # The last node that reads each node's mask (outputs are kept until the end)
+        self.last_use = list(range(len(self.nodes)))
+        for node_id, (op, args) in enumerate(self.nodes):
+            if op == "leaf": continue
+            for arg in args:
+                self.last_use[arg] = node_id
+        for node_id in self.outputs:
+            self.last_use[node_id] = len(self.nodes)
+        
+    def _add_node(self, key, op, args):
+        if key not in self.node_ids:
+            self.node_ids[key] = len(self.nodes)
+            self.nodes.append((op, args))
+            self.node_keys.append(key)
+        return self.node_ids[key]
+    
+    def _conjuncts(self, feature):
+        if isinstance(feature, SliceFeatureAnd):
+            return self._conjuncts(feature.lhs) + self._conjuncts(feature.rhs)
+        return [feature]
+        
+    def _compile(self, feature):
+        if isinstance(feature, SliceFeatureAnd):
+            operands = sorted(set(self._compile(f) for f in self._conjuncts(feature)))
+            node_id = operands[0]
+            for i in range(1, len(operands)):
+                key = ("and", frozenset(self.node_keys[o] for o in operands[:i + 1]))
+                node_id = self._add_node(key, "and", (node_id, operands[i]))
+            return node_id
+        elif isinstance(feature, SliceFeatureOr):
+            lhs, rhs = sorted((self._compile(feature.lhs), self._compile(feature.rhs)))
+            return self._add_node(("or", frozenset((self.node_keys[lhs], self.node_keys[rhs]))), "or", (lhs, rhs))
+        elif isinstance(feature, SliceFeatureNegation):
+            child = self._compile(feature.feature)
+            return self._add_node(("not", self.node_keys[child]), "not", (child,))
+        elif isinstance(feature, SliceFeature):
+            return self._add_node(feature, "leaf", (feature,))
+        return self._add_node(("all",), "all", ())
+    
+    def evaluate(self, inputs, univariate_masks=None, device='cpu', node_masks=None):
+        """
+        Computes the masks of the features in the plan.
+        
+        :param inputs: The data in any format supported by `Slice.make_mask`.
+        :param univariate_masks: If provided, a dictionary of cached masks for
+            univariate features, which is mutated to add any masks that the
+            plan computes.
+        :param node_masks: If provided, a dictionary (such as a `MaskCache`)
+            of cached masks for the logical nodes of the plan, keyed by their
+            structural keys. Cached nodes are not recomputed, and the masks
+            of the nodes that the plan computes are added to it. The cache
+            must only be used with the same inputs.
+        
+        :return: A boolean tensor of shape (rows, features), stored in
+            column-major order so that each feature's mask is contiguous.
+        """
+        if not self.outputs:
+            return torch.zeros((inputs.shape[0], 0), dtype=torch.bool, device=device)
+        masks = [None] * len(self.nodes)
+        last_use = self.last_use
+        if node_masks is not None:
+            # Look up the nodes that are needed from the outputs down, so that
+            # the operands of cached nodes are not computed
+            needed = [False] * len(self.nodes)
+            for node_id in self.outputs:
+                needed[node_id] = True
+            last_use = [len(self.nodes)] * len(self.nodes)
+            for node_id in reversed(range(len(self.nodes))):
+                op, args = self.nodes[node_id]
+                if not needed[node_id] or op in ("leaf", "all"): continue
+                masks[node_id] = node_masks.get(self.node_keys[node_id])
+                if masks[node_id] is not None: continue
+                for arg in args:
+                    needed[arg] = True
+                    if last_use[arg] == len(self.nodes): last_use[arg] = node_id
+            for node_id in self.outputs:
+                last_use[node_id] = len(self.nodes)
+        for node_id, (op, args) in enumerate(self.nodes):
+            if masks[node_id] is not None or (node_masks is not None and not needed[node_id]): continue
+            if op == "leaf":
+                mask = args[0].make_mask(inputs, univariate_masks=univariate_masks, device=device)
+            elif op == "all":
+                mask = torch.ones(inputs.shape[0], dtype=torch.bool, device=device)
+            elif op == "not":
+                mask = ~masks[args[0]]
+            elif op == "and":
+                mask = masks[args[0]] & masks[args[1]]
+            else:
+                mask = masks[args[0]] | masks[args[1]]
+            masks[node_id] = mask
+            if op != "leaf":
+                if node_masks is not None and op != "all":
+                    node_masks[self.node_keys[node_id]] = mask
+                for arg in args:
+                    if last_use[arg] == node_id: masks[arg] = None
+        return torch.stack([masks[node_id] for node_id in self.outputs]).T
+
+def score_slices_batch(slices_to_score, inputs, score_fns, max_features, min_items=None, device='cpu', univariate_masks=None, score_errors=None, memory_budget=None):
     univariate_masks = univariate_masks if univariate_masks is not None else {}
+    # If score_errors is a dictionary, it is filled with the standard error of
+    # each score for each slice (NaN if the score function has no estimate)
     scored_slices = {}
+    # Collapsed inputs count each row as the number of rows it represents
+    row_weights = None
+    if isinstance(inputs, ColumnarData) and inputs.row_weights is not None:
+        row_weights = torch.from_numpy(inputs.row_weights).to(device)
+    # Masks are only built for one batch of slices at a time
+    batch_size = auto_batch_size(inputs.shape[0], len(score_fns), memory_budget)
     
     for num_features in range(1, max_features + 1):
-        combined_masks = []
-        itemized_masks = [[] for _ in range(num_features)]
-        matched_slices = []
-        for new_slice in slices_to_score:
-            if len(new_slice.univariate_features()) != num_features: continue
-            
-            mask = new_slice.make_mask(inputs, univariate_masks=univariate_masks, device=device)
-            if min_items is not None and mask.sum() < min_items:
-                scored_slices[new_slice] = None
-                continue
-            
-            combined_masks.append(mask)
-            for i, feature in enumerate(new_slice.univariate_features()):
-                itemized_masks[i].append(feature.make_mask(inputs, univariate_masks=univariate_masks, device=device))
-            matched_slices.append(new_slice)
+        feature_slices = [s for s in slices_to_score if len(s.univariate_features()) == num_features]
+        for start_idx in range(0, len(feature_slices), batch_size):
+            matched_slices = []
+            for new_slice in feature_slices[start_idx:start_idx + batch_size]:
+                if min_items is not None and isinstance(inputs, ColumnarData):
+                    # Check the size of rare slices using the postings index
+                    conjunction = conjunction_features(new_slice.feature)
+                    rows = inputs.slice_rows([(f.feature_name, f.allowed_values) for f in conjunction]) if conjunction else None
+                    if rows is not None and inputs.count_rows(rows) < min_items:
+                        scored_slices[new_slice] = None
+                        continue
+                matched_slices.append(new_slice)
+            if not matched_slices: continue
+                
+            # Compute the masks of the whole batch at once, so that features
+            # shared between slices are intersected only once
+            combined_masks_batch = SliceMaskPlan(matched_slices).evaluate(inputs, univariate_masks=univariate_masks, device=device)
+            if min_items is not None:
+                if row_weights is None:
+                    slice_sizes = combined_masks_batch.sum(0)
+                else:
+                    slice_sizes = (combined_masks_batch * row_weights.unsqueeze(1)).sum(0)
+                large_enough = (slice_sizes >= min_items).cpu().numpy()
+                for new_slice in (s for s, keep in zip(matched_slices, large_enough) if not keep):
+                    scored_slices[new_slice] = None
+                matched_slices = [s for s, keep in zip(matched_slices, large_enough) if keep]
+                if not matched_slices: continue
+                # Select through the transpose to keep the masks column-major
+                combined_masks_batch = combined_masks_batch.T[torch.from_numpy(large_enough).to(device)].T
+            itemized_masks_batch = [torch.stack([s.univariate_features()[i].make_mask(inputs, univariate_masks=univariate_masks, device=device)
+                                                 for s in matched_slices]).T
+                                    for i in range(num_features)]
             
-        if combined_masks:
-            batch_size = 64
-            for start_idx in range(0, len(combined_masks), batch_size):
-                end_idx = min(len(combined_masks), start_idx + batch_size)
-                combined_masks_batch = torch.stack(combined_masks[start_idx:end_idx], 1)
-                itemized_masks_batch = [torch.stack(m[start_idx:end_idx], 1) for m in itemized_masks]
+            # All slices in the batch have the same number of features
+            batch_slice = matched_slices[0]
+            computed_scores = torch.zeros((len(score_fns), combined_masks_batch.shape[1])).to(device)
+            for i, (key, scorer) in enumerate(score_fns.items()):
+                computed_scores[i] = scorer.calculate_score(batch_slice, combined_masks_batch, itemized_masks_batch)
                 
-                computed_scores = torch.zeros((len(score_fns), combined_masks_batch.shape[1])).to(device)
+            if score_errors is not None:
+                computed_errors = torch.full_like(computed_scores, float('nan'))
                 for i, (key, scorer) in enumerate(score_fns.items()):
-                    computed_scores[i] = scorer.calculate_score(new_slice, combined_masks_batch, itemized_masks_batch)
-                
-                for i, new_slice in enumerate(matched_slices[start_idx:end_idx]):
-                    scored_slice = new_slice.rescore({fn_name: score.item() for fn_name, score in zip(score_fns, computed_scores[:,i])})
-                    scored_slices[new_slice] = scored_slice
+                    error = scorer.score_error(batch_slice, combined_masks_batch, itemized_masks_batch, computed_scores[i])
+                    if error is not None: computed_errors[i] = error
+            
+            for i, new_slice in enumerate(matched_slices):
+                scored_slice = new_slice.rescore({fn_name: score.item() for fn_name, score in zip(score_fns, computed_scores[:,i])})
+                scored_slices[new_slice] = scored_slice
+                if score_errors is not None:
+                    score_errors[new_slice] = {fn_name: error.item() for fn_name, error in zip(score_fns, computed_errors[:,i])}
     return scored_slices
 
 class RankedSliceList:
@@ -406,45 +599,64 @@ class RankedSliceList:
     slice-finding operation.
     """
     
-    def __init__(self, results, data, score_functions, eval_indexes=None, min_weight=0.0, max_weight=5.0, similarity_threshold=0.9, device='cpu'):
+    def __init__(self, results, data, score_functions, eval_indexes=None, min_weight=0.0, max_weight=5.0, similarity_threshold=0.9, device='cpu', columnar=None, mask_cache_bytes=None):
         """
         :param results: A list of Slice objects representing the results of a
             slice-finding operation
         :param data: The original discrete-valued dataframe or DiscretizedData
-            used to compute scores
+            used to compute scores. If the DiscretizedData has been collapsed,
+            masks and metrics are expanded to the original rows.
         :param score_functions: A dictionary of score names to score function
             objects
         :param similarity_threshold: Slices that have a higher Jaccard similarity
             than this threshold to already-returned slices will be omitted.
+        :param columnar: A ColumnarData for the data, if one has already been
+            created. Otherwise dense data is converted to a columnar store.
+        :param mask_cache_bytes: The maximum number of bytes of univariate
+            masks to keep in the `univariate_masks` cache (a `MaskCache`), or
+            None to use the default. Cache statistics are available from
+            `univariate_masks.stats()`. The same limit applies separately to
+            the `node_masks` cache, which holds the masks of conjunctions and
+            other logical combinations of features.
         """
         self.results = results
         self.data = data
         self.df = data.df if hasattr(data, 'df') else data
         self.eval_indexes = eval_indexes
         self.device = device
+        if columnar is None:
+            columnar = ColumnarData.from_inputs(data)
         if eval_indexes is not None:
-            if isinstance(self.df, pd.DataFrame):
-                self.eval_df = self.df.iloc[self.eval_indexes].values.astype(np.uint8)
+            if columnar is not None:
+                self.eval_df = columnar[self.eval_indexes]
             else:
-                self.eval_df = self.df[self.eval_indexes]
-                if isinstance(self.eval_df, csr_matrix):
-                    self.eval_df = self.eval_df.tocsc()
-            if not isinstance(self.eval_df, csc_matrix):
-                self.eval_df = torch.from_numpy(self.eval_df).to(self.device)
+                self.eval_df = self.df[self.eval_indexes].tocsc()
             self.score_functions = {fn_name: fn.subslice(self.eval_indexes).to(self.device)
                                     for fn_name, fn in score_functions.items()}
             self.eval_mask = self.eval_indexes
         else:
-            self.eval_df = self.df
+            self.eval_df = columnar if columnar is not None else self.df
             self.score_functions = score_functions
             self.eval_mask = np.arange(self.df.shape[0])
+        
+        self.row_inverse = getattr(data, 'row_inverse', None)
+        if self.row_inverse is not None:
+            # Original rows in the evaluation set, and the position of each
+            # one's unique row in eval_df
+            in_eval = np.zeros(self.df.shape[0], dtype=bool)
+            in_eval[self.eval_mask] = True
+            self.eval_row_indexes = np.flatnonzero(in_eval[self.row_inverse])
+            self.eval_row_groups = (np.cumsum(in_eval) - 1)[self.row_inverse[self.eval_row_indexes]]
             
         self.min_weight = min_weight
         self.max_weight = max_weight
         self.train_scores = pd.DataFrame([r.score_values for r in self.results])
         self.similarity_threshold = similarity_threshold
         
-        self.univariate_masks = {}
+        self.univariate_masks = MaskCache(mask_cache_bytes)
+        # Masks of the intermediate nodes of slice mask plans, so that slices
+        # that share features reuse each other's intersections
+        self.node_masks = MaskCache(mask_cache_bytes)
         self.score_cache = None # if the user sets this, we will cache eval scores
 
     def _rank_weighted_indexes(self, score_df, weights, k=None):
@@ -473,16 +685,40 @@ class RankedSliceList:
         except AttributeError:
             return Slice(feature_set)
         
-    def score_slice(self, slice_obj, return_mask=False):
+    def _make_mask(self, slice_obj):
+        """
+        Computes a slice's mask on the evaluation data, reusing the cached
+        masks of its features and of its subexpressions.
+        """
+        plan = SliceMaskPlan([slice_obj])
+        return plan.evaluate(self.eval_df, univariate_masks=self.univariate_masks, 
+                             device=self.device, node_masks=self.node_masks)[:,0]
+        
+    def score_slice(self, slice_obj, return_mask=False, mask=None):
+        """
+        Computes the scores of a slice on the evaluation data.
+        
+        :param slice_obj: A Slice object.
+        :param return_mask: If True, also return the slice's mask as a numpy
+            array.
+        :param mask: The slice's mask on the evaluation data, if it has already
+            been computed.
+        
+        :return: A dictionary of scores, and optionally the slice mask.
+        """
         if self.score_cache is not None and slice_obj in self.score_cache:
             group_scores, mask = self.score_cache[slice_obj]
         else:
-            mask = slice_obj.make_mask(self.eval_df, univariate_masks=self.univariate_masks, device=self.device)
-            itemized_masks = [self.univariate_masks[f] for f in slice_obj.univariate_features()]
+            if mask is None:
+                mask = self._make_mask(slice_obj)
+            # Masks may have been evicted from the cache since the slice mask
+            # was computed, so they are requested again
+            itemized_masks = [f.make_mask(self.eval_df, univariate_masks=self.univariate_masks, device=self.device)
+                              for f in slice_obj.univariate_features()]
             group_scores = {key: item.calculate_score(slice_obj, mask, itemized_masks).item()
                             for key, item in self.score_functions.items()}
             if self.score_cache is not None:
-                self.score_cache[slice_obj] = (group_scores, mask)
+                self.score_cache[slice_obj] = (group_scores, mask.clone())
             
         if return_mask:
             return group_scores, mask.cpu().numpy()
@@ -508,14 +744,26 @@ class RankedSliceList:
             mask_indptr = [0]
             mask_indices = []
 
-        for result_idx in result_indexes:
-            slice_obj = self.results[result_idx]
-            group_scores, mask = self.score_slice(slice_obj, return_mask=True)
+        # Masks of the slices that are not cached are computed in batches, so
+        # that subexpressions shared between slices are evaluated once
+        result_slices = [self.results[result_idx] for result_idx in result_indexes]
+        batch_size = auto_batch_size(self.eval_df.shape[0], len(self.score_functions))
+        batch_masks = {}
+        for slice_idx, slice_obj in enumerate(result_slices):
+            if slice_idx % batch_size == 0:
+                batch_slices = [s for s in result_slices[slice_idx:slice_idx + batch_size]
+                                if self.score_cache is None or s not in self.score_cache]
+                masks = SliceMaskPlan(batch_slices).evaluate(self.eval_df, univariate_masks=self.univariate_masks, 
+                                                             device=self.device, node_masks=self.node_masks)
+                batch_masks = {s: masks[:,i] for i, s in enumerate(batch_slices)}
+            group_scores, mask = self.score_slice(slice_obj, return_mask=True, mask=batch_masks.get(slice_obj))
             
             eval_scores.append(group_scores)
             eval_scored_slices.append(slice_obj.rescore(group_scores))
             
             if return_masks:
+                if self.row_inverse is not None:
+                    mask = mask[self.eval_row_groups]
                 mask_indptr.append(mask_indptr[-1] + mask.sum())
                 mask_indices.append(np.argwhere(mask).flatten())
             
@@ -574,9 +822,14 @@ class RankedSliceList:
     
     def slice_mask(self, slice_obj):
         """
-        Calculates the slice mask for the given slice.
+        Calculates the slice mask for the given slice. If the data has been
+        collapsed, the mask is over the original evaluation rows (see
+        `eval_row_indexes`) rather than the unique rows.
         """
-        return slice_obj.make_mask(self.eval_df, univariate_masks=self.univariate_masks)
+        mask = self._make_mask(slice_obj)
+        if self.row_inverse is not None:
+            mask = mask[torch.from_numpy(self.eval_row_groups).to(mask.device)]
+        return mask
         
     def generate_slice_description(self, slice_obj, metrics=None, metrics_mask=None, return_slice_mask=False):
         """
@@ -607,16 +860,23 @@ class RankedSliceList:
         if self.score_cache is not None and slice_obj in self.score_cache:
             slice_mask = self.score_cache[slice_obj][1]
         else:
-            slice_mask = slice_obj.make_mask(self.eval_df, univariate_masks=self.univariate_masks, device=self.device).cpu().numpy()
+            slice_mask = self._make_mask(slice_obj).cpu().numpy()
+        if self.row_inverse is not None:
+            # Expand the mask over unique rows to the original evaluation rows
+            slice_mask = np.asarray(slice_mask)[self.eval_row_groups]
+            eval_rows = self.eval_row_indexes
+            base_mask = eval_rows
+        else:
+            eval_rows = np.arange(self.df.shape[0])[self.eval_mask]
+            base_mask = self.eval_mask
         if metrics_mask is not None:
             slice_mask &= metrics_mask
-        mask = np.arange(self.df.shape[0])[self.eval_mask][slice_mask]
-        base_mask = self.eval_mask
+        mask = eval_rows[slice_mask]
         if metrics_mask is not None:
             base_mask = base_mask[metrics_mask]
-            eval_count = self.eval_df[metrics_mask].shape[0]
+            eval_count = int(np.sum(metrics_mask))
         else:
-            eval_count = self.eval_df.shape[0]
+            eval_count = len(eval_rows)
         
         slice_metrics["Count"] = {"type": "count", "count": len(mask), "share": len(mask) / eval_count}
         slice_desc["isEmpty"] = len(mask) == 0
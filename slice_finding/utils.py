@@ -2,6 +2,9 @@ import numpy as np
 import pandas as pd
 from scipy import sparse as sps
 from itertools import chain, combinations
+from multiprocessing import RawArray
+from collections import OrderedDict
+import torch
 
 class RankedList:
     """
@@ -36,6 +39,174 @@ class RankedList:
             self.items = self.items[:self.k]
             self.scores = self.scores[:self.k]
 
+def shared_array_buffer(arrays, alignment=8):
+    """
+    Copies a list of numpy arrays into a single shared-memory buffer, which
+    can be passed to worker processes.
+    
+    :param arrays: A list of numpy arrays.
+    :param alignment: Byte alignment of the start of each array.
+    
+    :return: A tuple (buffer, layout), where buffer is a RawArray and layout
+        is a list of (offset, dtype, shape) tuples for each array.
+    """
+    layout = []
+    offset = 0
+    for arr in arrays:
+        offset = (offset + alignment - 1) // alignment * alignment
+        layout.append((offset, arr.dtype.str, arr.shape))
+        offset += arr.nbytes
+    buffer = RawArray('B', max(offset, 1))
+    for arr, (arr_offset, dtype, shape) in zip(arrays, layout):
+        view = np.frombuffer(buffer, dtype=dtype, count=arr.size, offset=arr_offset).reshape(shape)
+        np.copyto(view, arr)
+    return buffer, layout
+
+def arrays_from_shared_buffer(buffer, layout):
+    """
+    Returns views of the arrays stored in a buffer created by
+    `shared_array_buffer`.
+    """
+    return [np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            for offset, dtype, shape in layout]
+
+# Default limit on the temporary memory used to evaluate a batch of slices
+DEFAULT_MEMORY_BUDGET = 256 * 2 ** 20
+
+def auto_batch_size(num_rows, num_score_fns, memory_budget=None):
+    """
+    Chooses the number of slices to evaluate at once so that the temporary
+    mask and score tensors fit in a memory budget. Each slice needs a few
+    boolean masks and about two float32 temporaries per score function over
+    all rows.
+    
+    :param num_rows: The number of rows in the masks.
+    :param num_score_fns: The number of score functions.
+    :param memory_budget: The budget in bytes, or None to use
+        DEFAULT_MEMORY_BUDGET.
+    :return: A batch size of at least 1.
+    """
+    if memory_budget is None: memory_budget = DEFAULT_MEMORY_BUDGET
+    bytes_per_slice = max(1, num_rows) * (3 + 8 * num_score_fns)
+    return max(1, int(memory_budget // bytes_per_slice))
+
+# Default limit on the memory used by a MaskCache
+DEFAULT_MASK_CACHE_BYTES = 256 * 2 ** 20
+
+class MaskCache:
+    """
+    A cache of boolean masks (such as the univariate masks passed to
+    `Slice.make_mask`) with a limit on its total size in bytes. Masks are
+    evicted in least-recently-used order. If `compress` is True, masks evicted
+    from the uncompressed part of the cache are first kept bit-packed, which
+    uses 1/8 of the memory, and are expanded again when they are next used.
+    
+    The cache supports the dictionary operations used by `make_mask` (`get`,
+    `in` and item assignment), so it can be passed wherever a dictionary of
+    masks is expected. Masks may be evicted at any time, so callers should
+    recompute a mask when it is not found.
+    """
+    def __init__(self, max_bytes=None, compress=True, compressed_fraction=0.25):
+        """
+        :param max_bytes: The maximum number of bytes of masks to store, or
+            None to use DEFAULT_MASK_CACHE_BYTES.
+        :param compress: If True, masks are bit-packed before being evicted.
+        :param compressed_fraction: The fraction of max_bytes used to store
+            bit-packed masks if compress is True.
+        """
+        super().__init__()
+        self.max_bytes = max_bytes if max_bytes is not None else DEFAULT_MASK_CACHE_BYTES
+        self.compress = compress
+        self.compressed_bytes_limit = int(self.max_bytes * compressed_fraction) if compress else 0
+        self.masks = OrderedDict()
+        self.compressed_masks = OrderedDict()
+        self.num_bytes = 0
+        self.num_compressed_bytes = 0
+        self.hits = 0
+        self.compressed_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def _mask_bytes(self, mask):
+        if isinstance(mask, torch.Tensor):
+            return mask.element_size() * mask.nelement()
+        return np.asarray(mask).nbytes
+    
+    def get(self, key, default=None):
+        if key in self.masks:
+            self.masks.move_to_end(key)
+            self.hits += 1
+            return self.masks[key]
+        if key in self.compressed_masks:
+            packed, num_rows, device = self.compressed_masks[key]
+            self.compressed_hits += 1
+            mask = torch.from_numpy(np.unpackbits(packed, count=num_rows).view(bool)).to(device)
+            self[key] = mask
+            return mask
+        self.misses += 1
+        return default
+    
+    def _remove(self, key):
+        if key in self.masks:
+            self.num_bytes -= self._mask_bytes(self.masks.pop(key))
+        elif key in self.compressed_masks:
+            self.num_compressed_bytes -= self.compressed_masks.pop(key)[0].nbytes
+    
+    def __getitem__(self, key):
+        mask = self.get(key)
+        if mask is None: raise KeyError(key)
+        return mask
+    
+    def __setitem__(self, key, mask):
+        self._remove(key)
+        self.masks[key] = mask
+        self.num_bytes += self._mask_bytes(mask)
+        # Compress or evict the least recently used masks, always keeping the
+        # newest one
+        while self.num_bytes + self.num_compressed_bytes > self.max_bytes and len(self.masks) > 1:
+            old_key, old_mask = self.masks.popitem(last=False)
+            self.num_bytes -= self._mask_bytes(old_mask)
+            if (self.compress and isinstance(old_mask, torch.Tensor) and 
+                old_mask.dtype == torch.bool and old_mask.dim() == 1):
+                packed = np.packbits(old_mask.cpu().numpy())
+                self.compressed_masks[old_key] = (packed, old_mask.shape[0], old_mask.device)
+                self.num_compressed_bytes += packed.nbytes
+            else:
+                self.evictions += 1
+            while self.num_compressed_bytes > self.compressed_bytes_limit and self.compressed_masks:
+                packed, _, _ = self.compressed_masks.popitem(last=False)[1]
+                self.num_compressed_bytes -= packed.nbytes
+                self.evictions += 1
+                
+    def __contains__(self, key):
+        return key in self.masks or key in self.compressed_masks
+    
+    def __len__(self):
+        return len(self.masks) + len(self.compressed_masks)
+    
+    def clear(self):
+        self.masks.clear()
+        self.compressed_masks.clear()
+        self.num_bytes = 0
+        self.num_compressed_bytes = 0
+        
+    def stats(self):
+        """
+        Returns a dictionary containing the number of lookups that found an
+        uncompressed or compressed mask, the number of misses and evictions,
+        the hit rate, and the number of masks and bytes currently stored.
+        """
+        lookups = self.hits + self.compressed_hits + self.misses
+        return {
+            "hits": self.hits,
+            "compressed_hits": self.compressed_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.compressed_hits) / lookups if lookups > 0 else 0.0,
+            "num_masks": len(self),
+            "bytes": self.num_bytes + self.num_compressed_bytes
+        }
+
 def pairwise_jaccard_similarities(mat):
     """
     Computes the Jaccard similarity between each row of the given sparse matrix.
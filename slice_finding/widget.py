@@ -132,6 +132,12 @@ class SliceFinderWidget(anywidget.AnyWidget):
         if change.new:
             self.rerun_sampler()
             
+    @traitlets.observe("should_cancel")
+    def cancel_flag_changed(self, change):
+        if change.new and self.running_sampler:
+            # Stop the searches running in the worker processes
+            self.slice_finder.cancel()
+            
     def rerun_sampler(self):
         self.thread_starter(self._rerun_sampler_background)
 
@@ -145,22 +151,19 @@ class SliceFinderWidget(anywidget.AnyWidget):
         self.num_slices = 10
         
         try:
-            sample_step = max(self.num_samples // 5, 50)
-            i = 0
-            base_progress = 0
-            while i < self.num_samples:
-                def update_sampler_progress(progress, total):
-                    self.sampler_run_progress = base_progress + progress / self.num_samples
-                self.slice_finder.progress_fn = update_sampler_progress
-                
-                results, sampled_idxs = self.slice_finder.sample(min(sample_step, self.num_samples - i))
-                self.num_samples_drawn += len(sampled_idxs)
+            def update_sampler_progress(progress, total):
+                self.sampler_run_progress = progress / max(total, 1)
+            self.slice_finder.progress_fn = update_sampler_progress
+            
+            # Show snapshots of the results while the sampler runs
+            num_samples_drawn = self.num_samples_drawn
+            snapshots = self.slice_finder.sample_iter(self.num_samples, snapshot_interval=1.0)
+            for results, sampled_idxs in snapshots:
+                self.num_samples_drawn = num_samples_drawn + len(sampled_idxs)
                 ranked_results = results.rank(self.score_weights, n_slices=self.num_slices)
                 self.update_slices(ranked_results)
-                base_progress += len(sampled_idxs) / self.num_samples
-                i += sample_step
                 if self.should_cancel:
-                    break
+                    self.slice_finder.cancel()
             self.running_sampler = False
             
             time.sleep(0.01)
@@ -411,10 +414,14 @@ class SliceFinderWidget(anywidget.AnyWidget):
         self.slice_intersection_labels = [self.get_slice_description(s) for s in slice_order]
         
         intersect_counts = []
-        base_mask = np.arange(manager.df.shape[0])[manager.eval_mask]
+        if manager.row_inverse is not None:
+            # Slice masks are over the original rows of collapsed data
+            base_mask = manager.eval_row_indexes
+        else:
+            base_mask = np.arange(manager.df.shape[0])[manager.eval_mask]
         
         def calculate_intersection_counts(prefix, current_mask=None):
-            count = current_mask.sum() if current_mask is not None else manager.eval_df.shape[0]
+            count = current_mask.sum() if current_mask is not None else len(base_mask)
             if count == 0: return
             if len(prefix) == len(slice_order):
                 info = {"slices": prefix, 
@@ -436,7 +443,7 @@ class SliceFinderWidget(anywidget.AnyWidget):
             calculate_intersection_counts(prefix + [1], current_mask & univ_mask)
             calculate_intersection_counts(prefix + [0], current_mask & ~univ_mask)
            
-        calculate_intersection_counts([], np.ones(manager.eval_df.shape[0], dtype=bool))
+        calculate_intersection_counts([], np.ones(len(base_mask), dtype=bool))
         self.slice_intersection_counts = intersect_counts 
         # for slice_combo in powerset(slice_masks.keys()):
         #     if len(slice_combo) == 0: continue